@@ -4,6 +4,15 @@ Created on Fri Sep 22 22:37:10 2017
 
 Some simple Pandas analysis of the inventory data, 
 more as a test and a placeholder for future use. 
+
+The file table can run to ~ 10**8 rows, far too many to pull into
+a DataFrame, so the DB does the counting and summing with GROUP BY,
+and picks out the largest, and we only ever see what is reported.
+
+The same analysis can be done on the files written by
+PerformInventory.py --output, without a DB at all. Those are read a
+chunk at a time, with just the columns needed, and from Parquet
+only the row groups which might hold rows we want.
 """
 
 import pandas as pd
@@ -11,11 +20,20 @@ import argparse
 import getpass
 import logging
 import os.path
-import numpy as np
+import operator
+import datetime
+try:
+    import pyarrow.dataset
+except ImportError: # Optional, for reading Parquet
+    pyarrow = None
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text, bindparam
+from sqlalchemy.orm import sessionmaker
 import sqlalchemy.exc
 
+import FileInventory
+
+ChunkRows = 100000 # Rows read from --input files at a time
 
 
 def GetArgs():
@@ -31,12 +49,17 @@ def GetArgs():
     gr.add_argument('--blank',     '-b', help='Permit blank password', action='store_true')
     ap.add_argument('--schema',    '-s', help='DB schema', default='inventory')
     ap.add_argument('--connector', '-c', help='DB connector', default='mysql+mysqlconnector')
+    ap.add_argument('--local',     '-l', help='Use this SQLite file rather than the DB server', metavar='FILE')
+    ap.add_argument('--input',     '-i', help='Read files written by PerformInventory.py --output instead of a DB',
+                    metavar='DIR')
+    ex.add_argument('--chunk-size', '-g', help='Rows to read from --input files at a time', type=int,
+                    default=ChunkRows)
     ex.add_argument('--sql-debug', '-q', help='Print details of SQL commands', action='store_true')
     ex.add_argument('--verbose',   '-v', help='Verbosity', action='count')
     
     args = ap.parse_args()
     
-    while not (args.blank or args.password): # Prompt for a password if required
+    while not (args.blank or args.password or args.input or args.local): # Prompt for a password if required
         args.password = getpass.getpass('Password: ')
 
     if not args.verbose: # Is None if not specified
@@ -44,28 +67,256 @@ def GetArgs():
 
     return args
 
-def GetPathFromFileID(dirid, engine):
+class Database:
+    """
+    The analyses, done by the DB
+    """
+
+    Day = 24 * 3600
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.compact = FileInventory.Layout.Setup(engine)
+        self.cnx = engine.connect()
+
+    def Histogram(self, size):
+        """
+        Numbers of files bigger than size, in bins of size. (Queries
+        are text() so that SQLAlchemy adapts their parameters to the DB,
+        which might be a local SQLite one.)
+        """
+        sql = text("""select round(size * 1.0 / :size) as bin, count(id) as N 
+                from file where size > :size
+                group by round(size * 1.0 / :size) 
+                order by round(size * 1.0 / :size)""")
+        return pd.read_sql_query(sql, self.cnx, params = {'size': size}).set_index('bin')
+
+    def Daily(self):
+        """
+        Number and size of files created on each day. In the compact
+        layout times are seconds since the epoch, which are rounded down
+        to the start of the (local, going by the offset from UTC now) day.
+        """
+        if not self.compact:
+            sql = text("""select date(ctime) as day, count(id) as N, sum(size) as bytes
+                    from file where ctime is not null
+                    group by date(ctime) order by date(ctime)""")
+            return pd.read_sql_query(sql, self.cnx, parse_dates=['day']).set_index('day')
+        offset = int(datetime.datetime.now().astimezone().utcoffset().total_seconds())
+        sql = text("""select ctime - (ctime + :offset) % :day as day, count(id) as N, sum(size) as bytes
+                from file where ctime is not null
+                group by day order by day""")
+        daily = pd.read_sql_query(sql, self.cnx, params = {'offset': offset, 'day': Database.Day})
+        daily['day'] = pd.to_datetime(daily['day'] + offset, unit='s')
+        return daily.set_index('day')
+
+    def CreatedOn(self, day, size):
+        """
+        Directories with more than size bytes of files created on day
+        """
+        start = datetime.datetime.combine(day, datetime.time())
+        sql = text("""select parent, count(id) as number, sum(size) as bytes  
+                from file where ctime between :start and :end
+                group by parent having sum(size) > :size
+                order by parent""").bindparams( # Typed as the column is, whatever the layout
+                bindparam('start', type_=FileInventory.EpochTime()), bindparam('end', type_=FileInventory.EpochTime()))
+        return pd.read_sql_query(sql, self.cnx, params = {'start': start, 'size': size,
+                                 'end': start + datetime.timedelta(days=1)})
+
+    def LargestDirectories(self, number=20):
+        """
+        The directories with the most bytes directly in them. There is a
+        group per directory, which could be millions, so the DB picks out
+        the largest rather than sending them all
+        """
+        sql = text("""select parent, count(id) as number, sum(size) as bytes
+                from file group by parent
+                order by sum(size) desc limit :number""")
+        return pd.read_sql_query(sql, self.cnx, params = {'number': number})
+
+    def LargestTrees(self, number=20):
+        """
+        The directories just below the top of each job with the most bytes
+        anywhere under them. These come straight from the rollup table,
+        which the scanner fills in, so no files need to be looked at.
+        """
+        sql = text("""select r.directory_id as parent, r.files as number, r.bytes, r.directories
+                from rollup r, directory d, directory t
+                where d.id = r.directory_id and d.parent = t.id and t.parent is null
+                order by r.bytes desc limit :number""")
+        return pd.read_sql_query(sql, self.cnx, params = {'number': number})
+
+    def Resolver(self):
+        """
+        For turning directory IDs in to paths
+        """
+        return FileInventory.PathResolver(sessionmaker(bind=self.engine)())
+
+
+class Snapshot:
+    """
+    The same analyses as Database, but of the tables written to
+    directory by PerformInventory.py --output (see
+    InventoryWriter.ColumnarWriter). Tables are read a chunk at a
+    time and the totals added up as we go.
+    """
+
+    # For filters, which work on pyarrow expressions and pandas Series alike
+    Ops = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq,
+           'in': lambda column, values: column.isin(values)}
+
+    def __init__(self, directory, chunksize=ChunkRows):
+        self.directory = directory
+        self.chunksize = chunksize
+
+    def Read(self, table, columns, where=()):
+        """
+        Generates DataFrames of chunks of a table, with just the given
+        columns, and only the rows matching all of where, which is of
+        (column, op, value) tuples. From Parquet row groups whose
+        statistics show they can't match aren't even read. A table
+        with nothing in it won't have been written at all.
+        """
+        path = os.path.join(self.directory, table + '.parquet')
+        if os.path.exists(path):
+            if pyarrow is None:
+                raise ValueError("Reading Parquet needs pyarrow, which isn't installed")
+            expression = None
+            for column, op, value in where:
+                term = Snapshot.Ops[op](pyarrow.dataset.field(column), value)
+                expression = term if expression is None else expression & term
+            for batch in pyarrow.dataset.dataset(path).to_batches(columns=columns, filter=expression,
+                                                                  batch_size=self.chunksize):
+                yield batch.to_pandas()
+        elif os.path.exists(os.path.join(self.directory, table + '.csv.gz')):
+            model = FileInventory.Base.metadata.tables.get(table)
+            times = [c.name for c in model.columns if c.type.python_type is datetime.datetime] if model is not None else []
+            for chunk in pd.read_csv(os.path.join(self.directory, table + '.csv.gz'), usecols=columns,
+                                     parse_dates=[c for c in columns if c in times], chunksize=self.chunksize):
+                for column, op, value in where:
+                    chunk = chunk[Snapshot.Ops[op](chunk[column], value)]
+                yield chunk
+
+    @staticmethod
+    def Add(total, part):
+        """
+        Add part to a running total, either being a Series or DataFrame
+        """
+        return part if total is None else total.add(part, fill_value=0)
+
+    def Histogram(self, size):
+        counts = None
+        for chunk in self.Read('file', ['size'], [('size', '>', size)]):
+            counts = self.Add(counts, (chunk['size'] / size).round().value_counts())
+        counts = counts if counts is not None else pd.Series(dtype='int64')
+        return counts.sort_index().astype('int64').rename_axis('bin').to_frame('N')
+
+    def Daily(self):
+        totals = None
+        for chunk in self.Read('file', ['ctime', 'size']):
+            totals = self.Add(totals, chunk.groupby(chunk['ctime'].dt.floor('D'))['size'].agg(['count', 'sum']))
+        if totals is None:
+            return pd.DataFrame({'N': [], 'bytes': []}, index=pd.DatetimeIndex([], name='day'), dtype='int64')
+        return totals.rename(columns={'count': 'N', 'sum': 'bytes'}).rename_axis('day').astype('int64')
+
+    def CreatedOn(self, day, size):
+        start = datetime.datetime.combine(day, datetime.time())
+        totals = None
+        for chunk in self.Read('file', ['parent', 'ctime', 'size'],
+                               [('ctime', '>=', start), ('ctime', '<=', start + datetime.timedelta(days=1))]):
+            totals = self.Add(totals, chunk.groupby('parent')['size'].agg(['count', 'sum']))
+        if totals is None:
+            return pd.DataFrame({'parent': [], 'number': [], 'bytes': []}, dtype='int64')
+        totals = totals.rename(columns={'count': 'number', 'sum': 'bytes'}).astype('int64')
+        return totals[totals['bytes'] > size].reset_index()
+
+    def LargestDirectories(self, number=20):
+        # There are vastly fewer directories than files, so we can keep all their totals
+        totals = None
+        for chunk in self.Read('file', ['parent', 'size']):
+            totals = self.Add(totals, chunk.groupby('parent')['size'].agg(['count', 'sum']))
+        if totals is None:
+            return None
+        totals = totals.rename(columns={'count': 'number', 'sum': 'bytes'}).astype('int64')
+        return totals.nlargest(number, 'bytes').reset_index()
+
+    def LargestTrees(self, number=20):
+        tops = [i for chunk in self.Read('directory', ['id', 'parent']) for i in chunk['id'][chunk['parent'].isna()]]
+        below = [i for chunk in self.Read('directory', ['id', 'parent'], [('parent', 'in', tops)]) for i in chunk['id']]
+        largest = None
+        for chunk in self.Read('rollup', ['directory_id', 'files', 'bytes', 'directories'],
+                               [('directory_id', 'in', below)]):
+            largest = pd.concat([largest, chunk]).nlargest(number, 'bytes')
+        if largest is None:
+            return pd.DataFrame(columns=['parent', 'number', 'bytes', 'directories'])
+        return largest.rename(columns={'directory_id': 'parent', 'files': 'number'}).reset_index(drop=True)
+
+    def Resolver(self):
+        resolver = FileInventory.PathResolver(None)
+        roots = {}
+        for chunk in self.Read('job', ['id', 'path']):
+            roots.update(zip(chunk['id'], chunk['path']))
+        for chunk in self.Read('directory', ['id', 'parent', 'name', 'job_id']):
+            for job_id, rows in chunk.groupby('job_id'):
+                parents = [None if pd.isna(parent) else int(parent) for parent in rows['parent']]
+                resolver.Add(job_id, roots[job_id], zip(rows['id'], parents, rows['name']))
+        return resolver
+
+
+def Analyse(source):
     """
-    Returns a full path from a directory ID
+    Do the analysis, of a Database or a Snapshot
     """
+    # Get histogram bins for numbers of large (> 1GB) files
+    df2 = source.Histogram(2**30).rename_axis('GB')
+    df2.plot.bar(title='Large File sizes in GB')
+
+    # Now add up the amount of data created on each day
+    
+    df4 = source.Daily()
+    if df4.empty: # Then there is nothing more to be said
+        print('There are no files to analyse')
+        return
+    df4.plot(y='bytes', style='.', logy=True, title='Bytes created per day')
+    
+    # And work out the day on which the most was created...
+    
+    pt = df4['N'].idxmax().date()
+    df5 = source.CreatedOn(pt, 2**20)
+    
+    # Then find out what directories it was created in, getting
+    # all their paths at once rather than a query per level of each
     
-    path = ''
-    dirid = int(dirid)
-    parent = dirid
-    while parent:
-        sql = """select name, parent from directory where id = %(id)s limit 1""" 
-        (name, parent) = engine.execute(sql, {'id': parent}).fetchone()
-        if parent:
-            path = os.path.join(name, path)
-
-    sql = """select job.path from job, directory 
-            where job.id = directory.job_id and 
-            directory.id = %(dirid)s"""
-    (root,) = engine.execute(sql, {'dirid': dirid}).fetchone()
-
-    path = os.path.join(root, path)
-    return os.path.normpath(path)
+    resolver = source.Resolver()
+    df5['path'] = resolver.Paths(df5['parent'])
     
+    # Now get all the directories where there was more than 1MB created
+    # on the day and print them...
+    print('Peak day for creation was {:%d %B %Y}'.format(pt))
+    print('Locations of files > 1MB created on that are:')
+    for _, row in df5.iterrows():
+        print('{:80} {:6,} files {:8.1f} MB'.format(
+                row['path'], row['number'], row['bytes']/2**20))
+
+    # And which directories have the most in them overall
+    
+    df6 = source.LargestDirectories()
+    if df6 is not None:
+        df6['path'] = resolver.Paths(df6['parent'])
+        print('Largest directories are:')
+        for _, row in df6.iterrows():
+            print('{:80} {:6,} files {:8.1f} MB'.format(
+                    row['path'], row['number'], row['bytes']/2**20))
+
+    # And which have the most under them, subdirectories and all
+    
+    df7 = source.LargestTrees()
+    df7['path'] = resolver.Paths(df7['parent'])
+    print('Largest trees are:')
+    for _, row in df7.iterrows():
+        print('{:80} {:6,} files {:8.1f} MB in {:,} directories'.format(
+                row['path'], row['number'], row['bytes']/2**20, row['directories']))
+
 if __name__ == '__main__':
     args = GetArgs()
         
@@ -73,58 +324,23 @@ if __name__ == '__main__':
     level = loglevels[min(args.verbose, len(loglevels)- 1)]
     logging.basicConfig(level = level, format = '%(asctime)s %(message)s')
     
-    if args.password:
-        connectstr = '{}://{}:{}@{}/{}'.format(args.connector, args.user, 
-                      args.password, args.host, args.schema)
+    if args.input:
+        Analyse(Snapshot(args.input, args.chunk_size))
     else:
-        connectstr = '{}://{}@{}/{}'.format(args.connector, args.user, 
-                      args.host, args.schema)
-        
-    try:
-        engine = create_engine(connectstr, pool_recycle=3600, 
-                               echo = True if args.sql_debug else False)
-    except sqlalchemy.exc.NoSuchModuleError as e:
-        logging.critical("Error creating engine: {}".format(e))
-    else:
-        cnx = engine.connect()
-        # Get the DB to return histogram bins for numbers of large
-        # (> 1GB) files
-        sql = """select round(size/%(size)s) as %(label)s, count(id) as N 
-                from file where size > %(size)s
-                group by round(size/%(size)s) 
-                order by round(size/%(size)s)"""
-        df = pd.read_sql_query(sql, cnx, params = {'size': 2**30, 'label': 'GB'})
-        df2 = df.set_index('GB')
-        df2.plot.bar(title='Large File sizes in GB')
-
-        # Now get Pandas to analyse the amount of data created
-        # on a particular day
-        
-        sql = """select ctime, size from file"""
-        df3 = pd.read_sql_query(sql, cnx)
-        df3.plot(x='ctime', y='size', style=',', logy=True)
-        df4 = df3.set_index('ctime').resample('D').count()
-        
-        # And work out the day on which the most was created...
-        
-        pt = df4['size'].idxmax().date()
-        sql = """select parent, count(id) as number, sum(size) as bytes  
-                from file where ctime between %(pt)s and 
-                DATE_ADD(%(pt)s, interval 1 day) 
-                group by parent order by parent"""
-        df5 = pd.read_sql_query(sql, cnx, params = {'pt':pt})
-        
-        # Then find out what directories it was created in
-        
-        df5['path'] =  np.vectorize(GetPathFromFileID)(df5['parent'], engine)
-        
-        # Now get all the directories where there was more than 1MB created
-        # on the day and print them...
-        print('Peak day for creation was {:%d %B %Y}'.format(pt))
-        print('Locations of files > 1MB created on that are:')
-        for _, row in df5[df5['bytes'] > 2**20].iterrows():
-            print('{:80} {:6,} files {:8.1f} MB'.format(
-                    row['path'], row['number'], row['bytes']/2**20))
-        
-        
-        
+        if args.password:
+            connectstr = '{}://{}:{}@{}/{}'.format(args.connector, args.user, 
+                          args.password, args.host, args.schema)
+        else:
+            connectstr = '{}://{}@{}/{}'.format(args.connector, args.user, 
+                          args.host, args.schema)
+            
+        try:
+            if args.local:
+                engine = FileInventory.LocalEngine(args.local, echo = True if args.sql_debug else False)
+            else:
+                engine = create_engine(connectstr, pool_recycle=3600, 
+                                       echo = True if args.sql_debug else False)
+        except sqlalchemy.exc.NoSuchModuleError as e:
+            logging.critical("Error creating engine: {}".format(e))
+        else:
+            Analyse(Database(engine))
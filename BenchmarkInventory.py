@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how fast the inventory scans, stores, checksums and analyses
+files, without needing a production array to point it at.
+
+A synthetic tree is built in a temporary directory from a seeded
+random number generator, so the same arguments always give the same
+tree, and two versions of the code can be compared on equal terms.
+It has three parts, each of which stresses something different:
+
+    flat    one directory with a great many entries (try 10**5 to
+            10**6), which is all listdir and stat
+    deep    a long chain of nested directories with a few files in
+            each, which is all directory bookkeeping and rollups
+    mixed   a spread of small files and a few large ones, which is
+            where checksumming spends its time
+
+The tree is then scanned in to a local SQLite inventory with
+ProcessDirectory, its files checksummed one at a time with
+FileInventory.MD5 and then by a HashPool, and the AnalyseInventory
+queries run against the result. For each stage we report the time
+taken, files/s, bytes hashed/s, DB rows/s and the peak RSS so far.
+
+Note that the files have just been written, so they will mostly be
+in the page cache: the checksum rates are those of the hashing, not
+of the disks.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import logging
+import datetime
+import tempfile
+import resource
+
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+import FileInventory
+import InventoryWriter
+import HashInventory
+import PerformInventory
+import AnalyseInventory
+
+
+class TreeMaker:
+    """
+    Builds a reproducible synthetic tree under root. Everything,
+    names, sizes, contents and times, comes from one random.Random
+    so is fixed by the seed.
+    """
+
+    WriteBytes = 2**20 # Large files are written this much at a time
+    Epoch = datetime.datetime(2017, 1, 1).timestamp() # Times are spread over the year after
+    Year = 365 * 24 * 3600
+    # Names the scanner has to sanitise or otherwise take care over
+    OddNames = ['with space', 'tab\there', 'ünïcödé', 'quote\'s', 'semi;colon', 'x' * 240,
+                'bad\udcffbyte', '.hidden', 'percent%s', 'back\\slash']
+
+    def __init__(self, root, seed=0, odd=0):
+        self.root = root
+        self.random = random.Random(seed)
+        self.odd = odd # Fraction of names taken from OddNames
+        self.files = 0
+        self.bytes = 0
+        self.directories = 0
+
+    def Directory(self, path):
+        os.mkdir(path)
+        self.directories += 1
+        return path
+
+    def File(self, path, size):
+        """
+        Write size random bytes to path, and give it a random mtime
+        """
+        with open(path, 'wb') as f:
+            while size > 0:
+                block = min(size, TreeMaker.WriteBytes)
+                f.write(self.random.randbytes(block))
+                size -= block
+                self.bytes += block
+        when = TreeMaker.Epoch + self.random.random() * TreeMaker.Year
+        os.utime(path, (when, when))
+        self.files += 1
+
+    def Part(self, Build, *args):
+        """
+        Build(*args) one part of the tree, returning how many files
+        and bytes it wrote (for Benchmark.Run)
+        """
+        (files, size) = (self.files, self.bytes)
+        Build(*args)
+        return dict(files=self.files - files, bytes=self.bytes - size)
+
+    def Name(self, i):
+        """
+        A name for the i'th entry of a directory, now and then an odd one
+        """
+        if self.odd and self.random.random() < self.odd:
+            return '{} {}'.format(self.random.choice(TreeMaker.OddNames), i)
+        return 'f{:07d}.dat'.format(i)
+
+    def Flat(self, entries, max_size=4096):
+        """
+        One directory of entries small files
+        """
+        top = self.Directory(os.path.join(self.root, 'flat'))
+        for i in range(entries):
+            self.File(os.path.join(top, self.Name(i)), self.random.randint(0, max_size))
+
+    def Deep(self, depth, files=4, max_size=4096):
+        """
+        A chain of depth nested directories, with files in each
+        """
+        path = self.Directory(os.path.join(self.root, 'deep'))
+        for level in range(depth):
+            for i in range(files):
+                self.File(os.path.join(path, self.Name(i)), self.random.randint(0, max_size))
+            path = self.Directory(os.path.join(path, 'd{:04d}'.format(level)))
+
+    def Mixed(self, files, large, large_size, per_directory=1000):
+        """
+        files small files, their sizes roughly log-uniform up to 1 MB,
+        and large ones of about large_size, shared out between
+        directories of per_directory files
+        """
+        top = self.Directory(os.path.join(self.root, 'mixed'))
+        sizes = [int(2 ** self.random.uniform(0, 20)) for _ in range(files)]
+        sizes += [int(large_size * self.random.uniform(0.5, 1.5)) for _ in range(large)]
+        self.random.shuffle(sizes)
+        for i, size in enumerate(sizes):
+            if i % per_directory == 0:
+                path = self.Directory(os.path.join(top, 'm{:05d}'.format(i // per_directory)))
+            self.File(os.path.join(path, self.Name(i)), size)
+
+
+class Benchmark:
+    """
+    Times the stages, and prints what each managed
+    """
+
+    def __init__(self):
+        self.results = []
+
+    @staticmethod
+    def PeakRSS():
+        """
+        High water marks of our resident set size, and that of the
+        largest of our children (i.e. the hash workers), in MB
+        """
+        scale = 2**20 if sys.platform == 'darwin' else 2**10 # ru_maxrss is bytes on macOS, KB elsewhere
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+    def Run(self, stage, Function, *args):
+        """
+        Time Function(*args), which returns a dict of whatever it got
+        through out of files, bytes and rows
+        """
+        logging.info("Starting {}".format(stage))
+        start = time.perf_counter()
+        done = Function(*args) or {}
+        seconds = time.perf_counter() - start
+        self.results.append((stage, seconds, done, self.PeakRSS()))
+        logging.info("{} took {:.2f}s".format(stage, seconds))
+        return done
+
+    def Report(self):
+        print('{:<24} {:>9} {:>12} {:>12} {:>12} {:>9} {:>9}'.format(
+                'Stage', 'Seconds', 'Files/s', 'MB/s', 'Rows/s', 'RSS MB', 'Child MB'))
+        for stage, seconds, done, (rss, child) in self.results:
+            rate = lambda what, scale=1: '{:12,.0f}'.format(done[what] / scale / seconds) \
+                    if what in done and seconds > 0 else '{:>12}'.format('-')
+            print('{:<24} {:9.2f} {} {} {} {:9.0f} {:9.0f}'.format(
+                    stage, seconds, rate('files'), rate('bytes', 2**20), rate('rows'), rss, child))
+
+
+def Scan(session, root, workers, batch_size, db_writers=1):
+    """
+    Inventory root as a new job, as PerformInventory.py does
+    """
+    job = FileInventory.Job(path=root, owner='benchmark', comment='BenchmarkInventory.py')
+    session.add(job)
+    session.commit()
+    if db_writers:
+        writer = InventoryWriter.AsyncWriter(session, batch_size, writers=db_writers)
+    else:
+        writer = InventoryWriter.BatchWriter(session, batch_size)
+    PerformInventory.ProcessDirectory(writer, root, job.id, None, workers)
+    writer.Stop()
+    job.ended = datetime.datetime.now()
+    session.commit()
+    return dict(job=job.id, **Counts(session, job.id))
+
+
+def Counts(session, job_id):
+    """
+    Number of files a job has in the DB, and of rows altogether
+    (its files, directories and rollups)
+    """
+    first = FileInventory.File.MakeID(job_id, 0)
+    files = session.query(FileInventory.File).filter(
+            FileInventory.File.id.between(first, first + FileInventory.File.IDBlock - 1)).count()
+    directories = session.query(FileInventory.Directory).filter(FileInventory.Directory.job_id == job_id).count()
+    rollups = session.query(FileInventory.Rollup).filter(FileInventory.Rollup.job_id == job_id).count()
+    return dict(files=files, rows=files + directories + rollups)
+
+
+def SerialMD5(session, job_id):
+    """
+    Checksum every file in a job with FileInventory.MD5, one after another
+    """
+    paths = FileInventory.PathResolver(session)
+    paths.Load(job_id)
+    file = FileInventory.File
+    first = file.MakeID(job_id, 0)
+    files = size = 0
+    for r in session.query(file.parent, file.name, file.size).filter(
+            file.id.between(first, first + file.IDBlock - 1)):
+        if FileInventory.MD5(os.path.join(paths.Path(r.parent), r.name)):
+            files += 1
+            size += r.size
+    return dict(files=files, bytes=size)
+
+
+def PoolHash(session, job_id, workers, batch_size):
+    """
+    Checksum every file in a job with a HashPool, writing the digests
+    back as HashInventory.py does
+    """
+    pool = HashInventory.HashPool(workers)
+    HashInventory.HashJob(InventoryWriter.BatchWriter(session, batch_size), pool, job_id)
+    pool.Close()
+    first = FileInventory.File.MakeID(job_id, 0)
+    (files, size) = session.query(func.count(FileInventory.File.id), func.sum(FileInventory.File.size)).filter(
+            FileInventory.File.id.between(first, first + FileInventory.File.IDBlock - 1),
+            FileInventory.File.md5sum.isnot(None)).one()
+    return dict(files=files, bytes=size or 0, rows=files)
+
+
+def Analyses(bench, engine, chunk_size):
+    """
+    Time each of the AnalyseInventory queries
+    """
+    db = AnalyseInventory.Database(engine, chunk_size)
+    bench.Run('Analyse Daily', lambda: dict(rows=len(db.Daily())))
+    bench.Run('Analyse Histogram', lambda: dict(rows=len(db.Histogram(2**16))))
+    day = datetime.date.fromtimestamp(time.time()) # Just written, so that's when they were created
+    bench.Run('Analyse CreatedOn', lambda: dict(rows=len(db.CreatedOn(day, 0))))
+    bench.Run('Analyse LargestDirectories', lambda: dict(rows=len(db.LargestDirectories())))
+    bench.Run('Analyse LargestTrees', lambda: dict(rows=len(db.LargestTrees())))
+    db.cnx.close()
+
+
+def GetArgs():
+    """
+    Process command line arguments
+    """
+    ap = argparse.ArgumentParser(description='Benchmark the inventory on a synthetic tree')
+    ex = ap.add_argument_group(title='Exotic', description='Here be dragons')
+    ap.add_argument('--flat',         '-f', help='Entries in the flat directory', type=int, default=10000)
+    ap.add_argument('--deep',         '-d', help='Depth of the nested directories', type=int, default=200)
+    ap.add_argument('--small',        '-s', help='Small files in the mixed part', type=int, default=5000)
+    ap.add_argument('--large',        '-L', help='Large files in the mixed part', type=int, default=8)
+    ap.add_argument('--large-size',   '-z', help='Typical size of a large file', type=int, default=64 * 2**20)
+    ap.add_argument('--odd',          '-o', help='Fraction of names with odd characters in (those sanitised '
+                    'by the scan will not be found to checksum)', type=float, default=0)
+    ap.add_argument('--seed',         '-e', help='Random seed for the tree', type=int, default=0)
+    ap.add_argument('--tree',         '-t', help='Use this existing tree rather than building one',
+                    metavar='DIR')
+    ap.add_argument('--dir',          '-D', help='Where to make the temporary directory', metavar='DIR')
+    ap.add_argument('--compact',      '-C', help='Use the compact layout for the DB', action='store_true')
+    ap.add_argument('--keep',         '-k', help="Don't delete the tree and DB afterwards", action='store_true')
+    ap.add_argument('--skip',         '-x', help='Stages to leave out', nargs='+', default=[],
+                    choices=['md5', 'hash', 'analyse'])
+    ex.add_argument('--workers',      '-w', help='Number of threads walking the tree', type=int,
+                    default=1)
+    ex.add_argument('--hash-workers', '-H', help='Number of processes computing checksums', type=int)
+    ex.add_argument('--db-writers',   '-W', help='Number of threads writing to the DB (0 to write from the '
+                    'thread taking rows from the scan)', type=int, default=1)
+    ex.add_argument('--commit-rec',   '-r', help='Max records after which to commit', type=int,
+                    default=FileInventory.File.MaxCommitRecords)
+    ex.add_argument('--chunk-size',   '-g', help='Rows to read from the DB at a time', type=int,
+                    default=AnalyseInventory.ChunkRows)
+    ex.add_argument('--sql-debug',    '-q', help='Print details of SQL commands', action='store_true')
+    ex.add_argument('--verbose',      '-v', help='Verbosity', action='count')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = GetArgs()
+    if not args.verbose: # Is None if not specified
+        args.verbose = 0
+
+    loglevels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    level = loglevels[min(args.verbose, len(loglevels)- 1)]
+    logging.basicConfig(level = level, format = '%(asctime)s %(message)s')
+
+    work = tempfile.mkdtemp(prefix='inventory-bench-', dir=args.dir)
+    bench = Benchmark()
+    try:
+        if args.tree:
+            root = os.path.abspath(args.tree)
+        else:
+            root = os.path.join(work, 'tree')
+            os.mkdir(root)
+            maker = TreeMaker(root, args.seed, args.odd)
+            bench.Run('Generate flat', maker.Part, maker.Flat, args.flat)
+            bench.Run('Generate deep', maker.Part, maker.Deep, args.deep)
+            bench.Run('Generate mixed', maker.Part, maker.Mixed, args.small, args.large, args.large_size)
+            print('Built {:,} files of {:,} bytes in {:,} directories under {}'.format(
+                    maker.files, maker.bytes, maker.directories, root))
+
+        engine = FileInventory.LocalEngine(os.path.join(work, 'inventory.db'),
+                                           echo = True if args.sql_debug else False)
+        FileInventory.Layout.Setup(engine, args.compact)
+        FileInventory.Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        job_id = bench.Run('Scan', Scan, session, root, args.workers, args.commit_rec,
+                           args.db_writers)['job']
+        if 'md5' not in args.skip:
+            bench.Run('FileInventory.MD5', SerialMD5, session, job_id)
+        if 'hash' not in args.skip:
+            bench.Run('HashPool', PoolHash, session, job_id, args.hash_workers, args.commit_rec)
+        if 'analyse' not in args.skip:
+            Analyses(bench, engine, args.chunk_size)
+        session.close()
+        engine.dispose()
+    except KeyboardInterrupt:
+        logging.error("Benchmark interrupted by user!")
+    finally:
+        bench.Report()
+        if args.keep:
+            print('Kept {}'.format(work))
+        else:
+            shutil.rmtree(work, ignore_errors=True)
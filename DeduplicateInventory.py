@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Finds duplicate files in the inventory without hashing every file.
+
+Two files can only be identical if they are the same size, which we
+get for free from the stat data. So first group the files by size and
+throw away every file whose size is unique. Of what's left, read just
+the first and last few KB of each and throw away those which differ
+there. Only the files which survive both of those have to be read in
+their entirity. On a collection of MP3s, where sizes are all over the
+place, that is a tiny fraction of the total.
+
+Checksums already in the file table are reused where they were made
+with the same algorithm, and those computed here are written back.
+Results replace the contents of the duplicate table.
+
+Unless told which jobs to look at, only the latest finished job of
+each directory tree is, as a rescan finds all the same files again.
+Either way a file found by more than one job is read once, and isn't
+taken for a duplicate of itself.
+"""
+
+import os
+import argparse
+import getpass
+import logging
+import collections
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+import sqlalchemy.exc
+
+import FileInventory
+import InventoryWriter
+import HashInventory
+
+
+class Deduplicator:
+    """
+    Works through the size collisions in the file table (of certain
+    jobs, or by default the latest finished one of each path, see
+    Latest), a page of sizes at a time so the whole table is never in
+    memory at once.
+    """
+
+    SizesPerPage = 1000
+
+    def __init__(self, writer, pool, jobs=None, min_size=1, head=FileInventory.File.PartialHashBytes):
+        self.writer = writer
+        self.session = writer.session
+        self.pool = pool
+        self.head = head
+        self.min_size = min_size
+        jobs = jobs or Deduplicator.Latest(self.session)
+        query = self.session.query(FileInventory.Job.id, FileInventory.Job.digest)
+        self.digests = dict(query.filter(FileInventory.Job.id.in_(jobs))) # Algorithm used by each job in scope
+        self.reusable = {job for job, algorithm in self.digests.items() if algorithm == pool.algorithm}
+        self.paths = FileInventory.PathResolver(self.session)
+        for job_id in self.digests:
+            self.paths.Load(job_id)
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def Latest(session):
+        """
+        Query for the latest finished job of each path scanned
+        """
+        job = FileInventory.Job
+        return session.query(func.max(job.id)).filter(job.ended.isnot(None)).group_by(job.path)
+
+    def Files(self):
+        """
+        Query for the files in scope, joined to their directory
+        """
+        return self.session.query(FileInventory.File).join(
+                FileInventory.Directory, FileInventory.Directory.id == FileInventory.File.parent).filter(
+                FileInventory.Directory.job_id.in_(self.digests), FileInventory.File.size >= self.min_size)
+
+    def Sizes(self):
+        """
+        Generates pages of sizes shared by more than one file, largest
+        first as they are the ones worth knowing about
+        """
+        last = None
+        while True:
+            query = self.Files().with_entities(FileInventory.File.size).group_by(
+                    FileInventory.File.size).having(func.count() > 1)
+            if last is not None:
+                query = query.filter(FileInventory.File.size < last)
+            sizes = [size for (size,) in query.order_by(FileInventory.File.size.desc()).limit(
+                    Deduplicator.SizesPerPage)]
+            if not sizes:
+                break
+            yield sizes
+            last = sizes[-1]
+
+    def Run(self):
+        """
+        Find the duplicates and record them in the duplicate table
+        """
+        self.session.query(FileInventory.Duplicate).delete()
+        self.session.commit()
+        for sizes in self.Sizes():
+            rows = self.Files().with_entities(FileInventory.File.id, FileInventory.File.parent,
+                    FileInventory.File.name, FileInventory.File.size, FileInventory.File.md5sum,
+                    FileInventory.Directory.job_id).filter(FileInventory.File.size.in_(sizes)).all()
+            logging.info("Checking {} files of {} sizes from {} bytes".format(len(rows), len(sizes), sizes[0]))
+            self.stats['files'] += len(rows)
+            self.stats['bytes'] += sum(r.size for r in rows)
+            partial = self.Hash(rows, self.head)
+            candidates = self.Survivors(rows, partial)
+            # Files no bigger than the two ends put together have already been hashed in full
+            digests = {r: partial[r] for r in candidates if r.size <= 2 * self.head}
+            large = [r for r in candidates if r.size > 2 * self.head]
+            digests.update(zip(large, self.FullDigests(large)))
+            self.Record(candidates, digests)
+        self.writer.Flush()
+        logging.info("Read {partial:,} bytes from the ends and {full:,} bytes in full "
+                     "of {files:,} files totalling {bytes:,} bytes".format(**self.stats))
+
+    def Path(self, row):
+        return os.path.join(self.paths.Path(row.parent), row.name)
+
+    def Hash(self, rows, head=None):
+        """
+        Checksum rows (or just their ends) using the worker pool.
+        Returns a dict of row: digest. Rows from different jobs with
+        the same path are the same file, so it is only read once.
+        """
+        paths = {r: self.Path(r) for r in rows}
+        files = list({path: r for r, path in paths.items()}.items())
+        if self.pool.throttle: # Read them in the order kindest to the disks
+            files.sort(key=lambda f: HashInventory.Throttle.Key(f[1].size, f[1].parent, f[1].name))
+        if head:
+            self.stats['partial'] += sum(min(r.size, 2 * head) for _, r in files)
+        else:
+            self.stats['full'] += sum(r.size for _, r in files)
+        digests = dict(zip((path for path, _ in files),
+                           self.pool.Map([path for path, _ in files], head, [r.size for _, r in files])))
+        return {r: digests[path] for r, path in paths.items()}
+
+    def FullDigests(self, rows):
+        """
+        Full checksums of rows, reusing any already in the file table.
+        Newly computed ones are written back if they were made with
+        the algorithm the job uses.
+        """
+        digests = self.Hash([r for r in rows if not (r.md5sum and r.job_id in self.reusable)])
+        for r, digest in digests.items():
+            if digest and r.job_id in self.reusable:
+                self.writer.AddDigest(r.id, digest)
+        return [digests.get(r, r.md5sum) for r in rows]
+
+    def Survivors(self, rows, digests):
+        """
+        Those of rows whose (size, digest) is shared with a row at
+        another path: the same file found by more than one job is no
+        duplicate of itself
+        """
+        groups = collections.defaultdict(set)
+        for r in rows:
+            if digests[r]:
+                groups[(r.size, digests[r])].add(self.Path(r))
+        return [r for r in rows if digests[r] and len(groups[(r.size, digests[r])]) > 1]
+
+    def Record(self, rows, digests):
+        """
+        Write the rows which turn out to be duplicates to the DB, just
+        the one from the latest job for each path
+        """
+        latest = {}
+        for r in sorted(self.Survivors(rows, digests), key=lambda r: r.job_id):
+            latest[self.Path(r)] = r
+        duplicates = [dict(size=r.size, algorithm=self.pool.algorithm, digest=digests[r], file_id=r.id)
+                      for r in latest.values()]
+        if duplicates:
+            self.session.execute(FileInventory.Duplicate.__table__.insert(), duplicates)
+            self.session.commit()
+
+
+def Report(session, limit=20):
+    """
+    Print the groups of duplicates wasting the most space
+    """
+    dup = FileInventory.Duplicate
+    wasted = (dup.size * (func.count() - 1)).label('wasted')
+    groups = session.query(dup.size, dup.digest, func.count().label('number'), wasted).group_by(
+            dup.size, dup.digest)
+    summary = groups.subquery()
+    (number, total) = session.query(func.count(), func.sum(summary.c.wasted)).one()
+    print('{:,} groups of duplicates wasting {:.1f} MB'.format(number, (total or 0) / 2**20))
+    for g in groups.order_by(wasted.desc()).limit(limit):
+        print('{:6,} copies of {:12,} bytes ({})'.format(g.number, g.size, g.digest))
+
+
+def GetArgs():
+    """
+    Process command line arguments
+    """
+    ap = argparse.ArgumentParser(description='Find duplicate files in the inventory')
+    gr = ap.add_mutually_exclusive_group()
+    ex = ap.add_argument_group(title='Exotic', description='Here be dragons')
+    ap.add_argument('--host',         '-t', help='DB hostname or IP address', default='merlin')
+    ap.add_argument('--user',         '-u', help='DB username', default='tim')
+    gr.add_argument('--password',     '-p', help='DB password')
+    gr.add_argument('--blank',        '-b', help='Permit blank password', action='store_true')
+    ap.add_argument('--schema',       '-s', help='DB schema', default='inventory')
+    ap.add_argument('--connector',    '-c', help='DB connector', default='mysql+mysqlconnector')
+    ap.add_argument('--local',        '-l', help='Use this SQLite file rather than the DB server', metavar='FILE')
+    ap.add_argument('--digest',       '-a', help='Checksum algorithm', default='md5',
+                    choices=sorted(FileInventory.Digests))
+    ap.add_argument('--min-size',     '-z', help='Ignore files smaller than this', type=int, default=1)
+    ap.add_argument('--max-rate',     '-x', help='Read no more than this many MB/s', type=float)
+    ap.add_argument('--max-iops',     '-y', help='Make no more than this many reads/s', type=float)
+    ex.add_argument('--max-latency',  '-Y', help='Slow down if reads take longer than this many ms '
+                    '(default: when they take {} times as long as at best)'.format(
+                    HashInventory.Throttle.Backoff), type=float)
+    ex.add_argument('--partial-size', '-e', help='Bytes to compare from each end of a file', type=int,
+                    default=FileInventory.File.PartialHashBytes)
+    ex.add_argument('--hash-workers', '-H', help='Number of processes computing checksums', type=int)
+    ex.add_argument('--chunk-size',   '-g', help='Chunk size for computing checksums', type=int,
+                    default=FileInventory.File.DefaultMD5Chunk)
+    ex.add_argument('--commit-rec',   '-r', help='Max records after which to commit', type=int,
+                    default=FileInventory.File.MaxCommitRecords)
+    ex.add_argument('--sql-debug',    '-q', help='Print details of SQL commands', action='store_true')
+    ex.add_argument('--verbose',      '-v', help='Verbosity', action='count')
+
+    ap.add_argument('jobs', metavar='job', help='Only look at files from these jobs (default: the latest '
+                    'finished job of each path)', type=int, nargs='*')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = GetArgs()
+    while not (args.blank or args.password or args.local): # Prompt for a password if required
+        args.password = getpass.getpass()
+
+    if not args.verbose: # Is None if not specified
+        args.verbose = 0
+
+    loglevels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    level = loglevels[min(args.verbose, len(loglevels)- 1)]
+    logging.basicConfig(level = level, format = '%(asctime)s %(message)s')
+
+    if args.password:
+        connectstr = '{}://{}:{}@{}/{}'.format(args.connector, args.user,
+                      args.password, args.host, args.schema)
+    else:
+        connectstr = '{}://{}@{}/{}'.format(args.connector, args.user,
+                      args.host, args.schema)
+
+    try:
+        if args.local:
+            engine = FileInventory.LocalEngine(args.local, echo = True if args.sql_debug else False)
+        else:
+            engine = create_engine(connectstr, pool_recycle=3600,
+                                   echo = True if args.sql_debug else False)
+    except sqlalchemy.exc.NoSuchModuleError as e:
+        logging.critical("Error creating engine: {}".format(e))
+    else:
+        FileInventory.Layout.Setup(engine)
+        FileInventory.Duplicate.__table__.create(engine, checkfirst = True)
+        session = sessionmaker(bind=engine)()
+        writer = InventoryWriter.BatchWriter(session, args.commit_rec)
+        pool = HashInventory.HashPool(args.hash_workers, args.digest, args.chunk_size,
+                throttle=HashInventory.MakeThrottle(args.max_rate, args.max_iops, args.max_latency, args.chunk_size))
+        try:
+            Deduplicator(writer, pool, args.jobs, args.min_size, args.partial_size).Run()
+            Report(session)
+        except KeyboardInterrupt:
+            logging.error("Job interrupted by user!")
+            writer.Close()
+        pool.Close()
+        session.close()
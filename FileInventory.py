@@ -15,24 +15,163 @@ which returns lists of the entire contents.
 
 import os
 import os.path
+import time
 import argparse
 import itertools
 import datetime
 import hashlib
 import logging
 import re
+try:
+    import xxhash
+except ImportError: # Optional, for the xxh* digests
+    xxhash = None
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import create_engine, event, inspect, select
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Index
+from sqlalchemy import LargeBinary, TypeDecorator, UniqueConstraint
+from sqlalchemy.dialects import mysql
 from sqlalchemy.orm import validates
+import sqlalchemy.exc
 
 Base = declarative_base()
 
+# Checksum algorithms we know about, by the name recorded in Job.digest.
+# All of them give hex digests which fit in File.MaxDigestLength.
+Digests = {
+    'md5':     hashlib.md5,
+    'sha1':    hashlib.sha1,
+    'sha256':  hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+    'blake2s': hashlib.blake2s,
+}
+if xxhash:
+    Digests['xxh64']  = xxhash.xxh64
+    Digests['xxh128'] = xxhash.xxh3_128
+
+
+class Layout:
+    """
+    How the file table is stored. There can be ~ 10**8 rows, so every
+    byte counts: a table and indexes much bigger than the DB's cache
+    make every query wait on the disks. The compact layout keeps
+    checksums as binary rather than hex, times as whole seconds since
+    the epoch rather than DATETIME (or, in SQLite, text), and the
+    owner, group and mode, which hardly vary, as a reference to a row
+    of the attributes table, along with one to the file's extension.
+
+    Which is used is a property of the DB, found by Setup from the file
+    table if there is one, and otherwise chosen by whoever creates it.
+    It is noted on the engine's dialect, which is what the column types
+    get to see, so it must be done before the engine is used. Either way
+    the File columns look the same from Python (see HexDigest and
+    EpochTime), except that in the compact layout uid, gid and mode are
+    NULL and attributes_id and extension_id are filled in by an
+    Interner. MigrateInventory.py converts from one to the other.
+    """
+
+    Attribute = 'inventory_compact' # Of the dialect
+    BinaryTypes = (LargeBinary, mysql.VARBINARY, mysql.BINARY) # md5sum as reflected from a compact DB
+
+    @staticmethod
+    def Setup(engine, compact=False):
+        """
+        Find out which layout the DB has, or if it has no file table
+        yet, use the compact one if asked to. Returns whether it is compact.
+        """
+        inspector = inspect(engine)
+        if inspector.has_table(File.__tablename__):
+            types = {c['name']: c['type'] for c in inspector.get_columns(File.__tablename__)}
+            found = isinstance(types.get('md5sum'), Layout.BinaryTypes)
+            if compact and not found:
+                logging.warning("The DB has the wide layout: see MigrateInventory.py --compact")
+            compact = found
+        return Layout.Use(engine, compact)
+
+    @staticmethod
+    def Use(engine, compact):
+        """
+        Have the engine use a layout, whatever the DB has
+        """
+        setattr(engine.dialect, Layout.Attribute, compact)
+        return compact
+
+    @staticmethod
+    def Compact(dialect):
+        return getattr(dialect, Layout.Attribute, False)
+
+
+class HexDigest(TypeDecorator):
+    """
+    A checksum, which is a hex string in Python, kept in the DB as such
+    or, in the compact layout, as the binary it stands for (half the size)
+    """
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, length):
+        super().__init__(length)
+        self.length = length
+
+    @property
+    def python_type(self):
+        return str
+
+    def load_dialect_impl(self, dialect):
+        if not Layout.Compact(dialect):
+            return dialect.type_descriptor(String(self.length))
+        if dialect.name == 'mysql':
+            return dialect.type_descriptor(mysql.VARBINARY(self.length // 2))
+        return dialect.type_descriptor(LargeBinary(self.length // 2))
+
+    def process_bind_param(self, value, dialect):
+        if Layout.Compact(dialect) and isinstance(value, str):
+            return bytes.fromhex(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value).hex()
+        return value
+
+
+class EpochTime(TypeDecorator):
+    """
+    A time, which is a datetime in Python, kept in the DB as such or,
+    in the compact layout, as whole seconds since the epoch in a 32 bit
+    integer. Times which don't fit (before 1901 or after 2038, which
+    on a real file are nonsense anyway) are pinned to the ends.
+    """
+
+    impl = DateTime
+    cache_ok = True
+    Limits = (-2**31, 2**31 - 1)
+
+    @property
+    def python_type(self):
+        return datetime.datetime
+
+    def load_dialect_impl(self, dialect):
+        return dialect.type_descriptor(Integer() if Layout.Compact(dialect) else DateTime())
+
+    def process_bind_param(self, value, dialect):
+        if Layout.Compact(dialect) and isinstance(value, datetime.datetime):
+            return min(max(int(value.timestamp()), EpochTime.Limits[0]), EpochTime.Limits[1])
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, int):
+            return datetime.datetime.fromtimestamp(value)
+        return value
+
 class Job(Base):
     
     MaxOwnerNameLength =   20
     MaxHostNameLength  =   20
     MaxCommentLength   =   80
     MaxPathLength      = 4096
+    MaxDigestLength    =   16
     
     __tablename__ = 'job'
     id      = Column(Integer, primary_key = True)
@@ -42,18 +181,27 @@ class Job(Base):
     owner   = Column(String(MaxOwnerNameLength))
     host    = Column(String(MaxHostNameLength))
     comment = Column(String(MaxCommentLength))
-    md5sum  = Column(Boolean, nullable = True)
+    digest  = Column(String(MaxDigestLength), nullable = True) # Checksum algorithm, if any
+    previous = Column(Integer, ForeignKey('job.id'), nullable = True) # Job an incremental scan was based on
+    # What the scan got through (see InventoryStats), so runs can be compared
+    files   = Column(BigInteger)
+    directories = Column(BigInteger)
+    bytes   = Column(BigInteger)
+    hashed  = Column(BigInteger)
+    hashed_bytes = Column(BigInteger)
+    errors  = Column(Integer)
 
 class Directory(Base):
     
     Bates = itertools.count(1)
     MaxDirNameLength = 255
+    IDBlock          = 1<<32 # IDs reserved for each job's directories
     NameRe           = re.compile("[^-\(\)\w\s_\./-]")    
     __tablename__ = 'directory'
-    id      = Column(Integer, primary_key=True)
+    id      = Column(BigInteger, primary_key=True, autoincrement=False)
     job_id  = Column(Integer, ForeignKey('job.id', ondelete='CASCADE'), nullable=False)
     serial  = Column(Integer)
-    parent  = Column(Integer, ForeignKey('directory.id', ondelete='CASCADE'), nullable=True, index=True)
+    parent  = Column(BigInteger, ForeignKey('directory.id', ondelete='CASCADE'), nullable=True, index=True)
     name    = Column(String(MaxDirNameLength), index=True)
     ctime   = Column(DateTime)
     mtime   = Column(DateTime)
@@ -62,6 +210,7 @@ class Directory(Base):
     size    = Column(BigInteger)
     uid     = Column(Integer)
     gid     = Column(Integer)
+    complete = Column(Boolean, default=False) # All its files are in the DB, so needn't be rescanned on resume
     
     @validates('name')
     def ValidateName(self, key, value):
@@ -70,12 +219,30 @@ class Directory(Base):
         their names. This breaks MySQL varchar() quite horribly, so strip
         nonsense characters out.
         """
+        return Directory.CleanName(value)
+
+    @staticmethod
+    def CleanName(value):
+        """
+        Does the work for ValidateName. Split out so that bulk inserts,
+        which bypass the ORM and hence the validator, can use it too.
+        """
         if type(value) is bytes:
             name = value.decode('utf-8')
         else:
             name = str(value)
         return Directory.NameRe.sub('?', name)
 
+    @staticmethod
+    def MakeID(job_id, serial):
+        """
+        Directory IDs are allocated by the scanner rather than the DB
+        so that child rows can refer to their parent without waiting
+        for it to be committed. Each job owns a block of IDs, offset
+        by the Bates serial number, so concurrent jobs can't collide.
+        """
+        return job_id * Directory.IDBlock + serial
+
     def __repr__(self):
         return "ID={} Parent={} Name={}".format(self.id, self.parent, self.name)
     
@@ -86,23 +253,36 @@ class File(Base):
     
     Bates = itertools.count(1)
     MaxFileNameLength =   255 # I've never seen one this long, fnarr, frnarr, but it is possible
-    MD5SumLength      =    32
+    MaxDigestLength   =    64 # Hex, enough for SHA-256 or BLAKE2b-256
     DefaultMD5Chunk   = 1<<24 # 16 MiB
+    PartialHashBytes  = 1<<16 # Read from each end of a file for a quick comparison
+    MaxCommitRecords  = 10000 # Rows buffered before a bulk insert
+    IDBlock           = 1<<32 # IDs reserved for each job's files
     NameRe            = re.compile("[^-\(\)\w\s_\.-]")
+    BatchNameRe       = re.compile("[^-\x00\(\)\w\s_\.-]") # NameRe, but leaving NULs (see CleanNames)
     
+    # Covering the queries which go through the whole table: files by
+    # directory with their sizes (e.g. totals per directory), and by
+    # size (e.g. DeduplicateInventory.py, histograms of size), with
+    # the directory for the job and the checksum to compare them by.
+    # Nothing looks files up by name, so that isn't indexed.
     __tablename__ = 'file'
-    id      = Column(Integer, primary_key = True)
+    __table_args__ = (Index('ix_file_parent_size', 'parent', 'size'),
+                      Index('ix_file_size_parent_md5sum', 'size', 'parent', 'md5sum'))
+    id      = Column(BigInteger, primary_key = True, autoincrement=False)
     serial  = Column(Integer)
-    parent  = Column(Integer, ForeignKey('directory.id', ondelete='CASCADE'), nullable=False)
-    name    = Column(String(MaxFileNameLength), index=True)
-    ctime   = Column(DateTime)
-    mtime   = Column(DateTime)
-    atime   = Column(DateTime)
+    parent  = Column(BigInteger, ForeignKey('directory.id', ondelete='CASCADE'), nullable=False)
+    name    = Column(String(MaxFileNameLength))
+    ctime   = Column(EpochTime)
+    mtime   = Column(EpochTime)
+    atime   = Column(EpochTime)
     mode    = Column(Integer)
     size    = Column(BigInteger)
     uid     = Column(Integer)
     gid     = Column(Integer)
-    md5sum  = Column(String(MD5SumLength), index=True)
+    md5sum  = Column(HexDigest(MaxDigestLength), index=True) # Using the job's digest, not necessarily MD5
+    attributes_id = Column(Integer, ForeignKey('attributes.id'), nullable=True) # Compact layout only
+    extension_id  = Column(Integer, ForeignKey('extension.id'), nullable=True)
     
     @validates('name')
     def ValidateName(self, key, value):
@@ -111,8 +291,40 @@ class File(Base):
         their names. This breaks MySQL varchar() quite horribly, so strip
         nonsense characters out.
         """
+        return File.CleanName(value)
+
+    @staticmethod
+    def CleanName(value):
+        """
+        Does the work for ValidateName. Split out so that bulk inserts,
+        which bypass the ORM and hence the validator, can use it too.
+        """
         name = value.decode('utf-8')
         return File.NameRe.sub('?', name)
+
+    @staticmethod
+    def CleanNames(names):
+        """
+        CleanName for a whole batch of names (as str, straight from
+        os.scandir) at once. The regex is run once over all of them
+        joined together, separated by NUL which can't be in a name,
+        rather than once per name. Names too long for the column are
+        cut down to their last MaxFileNameLength bytes, so as to keep
+        the extension.
+        """
+        limit = File.MaxFileNameLength
+        names = [n if len(n) * 4 <= limit else # Can't be too long even if every character is 4 bytes
+                 n.encode('utf-8', 'surrogateescape')[-limit:].decode('utf-8', 'ignore') for n in names]
+        return File.BatchNameRe.sub('?', '\0'.join(names)).split('\0')
+
+    @staticmethod
+    def MakeID(job_id, serial):
+        """
+        As for Directory.MakeID. Knowing the ID of a file before it
+        is written means its checksum can be computed elsewhere and
+        written back later.
+        """
+        return job_id * File.IDBlock + serial
     
 
     def __repr__(self):
@@ -122,24 +334,381 @@ class File(Base):
         return self.name < other.name
 
 
-def MD5(filename, block_size=File.DefaultMD5Chunk):
+class Attributes(Base):
+    """
+    A combination of owner, group and mode, which in the compact
+    layout files refer to rather than repeat. There are few enough
+    that all of them are kept in memory (see Interner).
     """
-    Compute the MD5 of a file. Ordinarily we would just slurp the
+
+    __tablename__ = 'attributes'
+    __table_args__ = (UniqueConstraint('uid', 'gid', 'mode'),)
+    id   = Column(Integer, primary_key = True)
+    uid  = Column(Integer)
+    gid  = Column(Integer)
+    mode = Column(Integer)
+
+
+class Extension(Base):
+    """
+    A file name extension (lower case, with the dot), which in the
+    compact layout files refer to
+    """
+
+    MaxLength = 16
+    Re = re.compile(r'\.[a-z0-9_+~-]{1,15}$') # Anything else isn't really an extension
+
+    __tablename__ = 'extension'
+    id   = Column(Integer, primary_key = True)
+    name = Column(String(MaxLength), unique=True)
+
+    @staticmethod
+    def Of(name):
+        match = Extension.Re.search(name.lower())
+        return match.group() if match else None
+
+
+class Interner:
+    """
+    Turns file rows in to those of the compact layout and back, by
+    looking their attributes and extensions up in (and if need be
+    adding them to) the attributes and extension tables. Both tables
+    are read in full to begin with and then only added to, so there
+    is no query per row. Just to Decode, a connection will do instead
+    of a session.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.Load()
+
+    def Load(self):
+        self.attributes = {(r.uid, r.gid, r.mode): r.id
+                           for r in self.session.execute(select([Attributes.__table__]))}
+        self.extensions = {r.name: r.id for r in self.session.execute(select([Extension.__table__]))}
+        self.decode = {v: k for k, v in self.attributes.items()}
+
+    def Intern(self, table, values, known, key):
+        """
+        Add any values not in known to a dictionary table, in which
+        case it is read again. key makes a row of a value.
+        """
+        new = [v for v in set(values) if v not in known]
+        if not new:
+            return
+        try:
+            self.session.execute(table.insert(), [key(v) for v in new])
+            self.session.commit()
+        except sqlalchemy.exc.IntegrityError: # Someone else has just added some of them
+            self.session.rollback()
+            for v in new:
+                if v not in known:
+                    try:
+                        self.session.execute(table.insert(), key(v))
+                        self.session.commit()
+                    except sqlalchemy.exc.IntegrityError:
+                        self.session.rollback()
+        self.Load()
+
+    def Encode(self, rows):
+        """
+        Convert rows for the file table from the wide layout (as made by
+        InventoryWriter.FileRows) to the compact one, in place
+        """
+        self.Intern(Attributes.__table__, [(r['uid'], r['gid'], r['mode']) for r in rows], self.attributes,
+                    lambda v: dict(uid=v[0], gid=v[1], mode=v[2]))
+        names = [Extension.Of(r['name']) for r in rows]
+        self.Intern(Extension.__table__, [n for n in names if n], self.extensions, lambda v: dict(name=v))
+        for r, name in zip(rows, names):
+            r['attributes_id'] = self.attributes[(r.pop('uid'), r.pop('gid'), r.pop('mode'))]
+            r['extension_id'] = self.extensions.get(name)
+        return rows
+
+    def Decode(self, rows):
+        """
+        The reverse of Encode, for rows (as dicts) read from a DB with
+        the compact layout
+        """
+        for r in rows:
+            if r.get('attributes_id') is not None:
+                r['uid'], r['gid'], r['mode'] = self.decode[r['attributes_id']]
+            r['attributes_id'] = r['extension_id'] = None
+        return rows
+
+
+class Duplicate(Base):
+    """
+    A file found to be identical to at least one other. Files with the
+    same size and digest form a group of duplicates. See
+    DeduplicateInventory.py.
+    """
+
+    __tablename__ = 'duplicate'
+    __table_args__ = (Index('ix_duplicate_group', 'size', 'digest'),)
+    id        = Column(Integer, primary_key = True)
+    size      = Column(BigInteger)
+    algorithm = Column(String(Job.MaxDigestLength))
+    digest    = Column(String(File.MaxDigestLength))
+    file_id   = Column(BigInteger, ForeignKey('file.id', ondelete='CASCADE'), nullable=False)
+
+    def __repr__(self):
+        return "Size={} Digest={} File={}".format(self.size, self.digest, self.file_id)
+
+
+class Change(Base):
+    """
+    Something which has changed since the previous job, recorded by an
+    incremental scan. Added and modified files refer to this job, and
+    deleted ones to the previous job. A directory which has been added
+    or deleted implies all its contents, which aren't listed.
+    """
+
+    Added    = 'added'
+    Deleted  = 'deleted'
+    Modified = 'modified'
+    MaxKindLength = 8
+
+    __tablename__ = 'change'
+    id           = Column(Integer, primary_key = True)
+    job_id       = Column(Integer, ForeignKey('job.id', ondelete='CASCADE'), nullable=False, index=True)
+    kind         = Column(String(MaxKindLength))
+    file_id      = Column(BigInteger, nullable=True)
+    directory_id = Column(BigInteger, nullable=True)
+
+    def __repr__(self):
+        return "Job={} {} File={} Directory={}".format(self.job_id, self.kind, self.file_id, self.directory_id)
+
+
+class Rollup(Base):
+    """
+    Totals for a directory and everything under it, worked out by the
+    scanner as it finishes each subtree, so that e.g. how much is under
+    a directory is a lookup rather than a scan of the file table. The
+    own_ columns count just the files directly in the directory.
+    """
+
+    __tablename__ = 'rollup'
+    directory_id    = Column(BigInteger, ForeignKey('directory.id', ondelete='CASCADE'), primary_key=True)
+    job_id          = Column(Integer, ForeignKey('job.id', ondelete='CASCADE'), nullable=False, index=True)
+    files           = Column(BigInteger)
+    bytes           = Column(BigInteger, index=True)
+    directories     = Column(Integer) # Not counting itself
+    first_ctime     = Column(DateTime)
+    last_ctime      = Column(DateTime)
+    first_mtime     = Column(DateTime)
+    last_mtime      = Column(DateTime)
+    own_files       = Column(Integer)
+    own_bytes       = Column(BigInteger)
+    own_first_ctime = Column(DateTime)
+    own_last_ctime  = Column(DateTime)
+    own_first_mtime = Column(DateTime)
+    own_last_mtime  = Column(DateTime)
+
+    def __repr__(self):
+        return "Directory={} Files={} Bytes={}".format(self.directory_id, self.files, self.bytes)
+
+
+class Hasher:
+    """
+    Computes checksums of files. Ordinarily we would just slurp the
     file in to memory and compute its sum, but as we might encounter
     huge files (e.g. several GB), this might be too much to fit in
     available memory. So break the file in to manageable chunks.
+
+    The chunks are read with readinto in to a single buffer which is
+    allocated once and reused for every file, rather than allocating
+    a fresh bytes object per read, which on millions of small files
+    churns the allocator. Where the OS supports it we also tell it
+    that we will read sequentially, and that once we have read a big
+    file we won't want it again, so hashing an ISO doesn't flush
+    everything else out of the page cache.
+
+    How many reads the last file took, and how many seconds they took
+    between them, are kept in reads and seconds, so whoever is
+    scheduling the hashing can tell when the disks are struggling.
     """
-    try:
-        with open(filename, 'rb') as f:
-            md5 = hashlib.md5()
-            while True:
-                data = f.read(block_size)
-                if not data:
-                    break
-                md5.update(data)
-            return md5.hexdigest()    
-    except FileNotFoundError as e:
-        logging.error('Can\'t open {} for reading: {}'.format(filename, e))
+
+    def __init__(self, algorithm='md5', block_size=File.DefaultMD5Chunk):
+        self.algorithm = algorithm
+        self.new = Digests[algorithm]
+        self.buffer = memoryview(bytearray(block_size))
+        self.reads = 0
+        self.seconds = 0.0
+
+    def Digest(self, filename, head=None):
+        """
+        Return the hex digest of a file, or None if it can't be read.
+        If head is given, and the file is more than twice that size,
+        only the first and last head bytes are read: a cheap way of
+        telling whether two files of the same size differ.
+        """
+        self.reads = 0
+        self.seconds = 0.0
+        try:
+            with open(filename, 'rb', buffering=0) as f:
+                digest = self.new()
+                fd = f.fileno()
+                size = os.fstat(fd).st_size
+                if head and size > 2 * head:
+                    self.Update(f, digest, head)
+                    f.seek(-head, os.SEEK_END)
+                    self.Update(f, digest, head)
+                else:
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    self.Update(f, digest)
+                    if size > len(self.buffer) and hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                return digest.hexdigest()
+        except OSError as e:
+            logging.error('Can\'t open {} for reading: {}'.format(filename, e))
+
+    def Update(self, f, digest, limit=None):
+        """
+        Feed digest with the rest of file f, or at most limit bytes of it
+        """
+        while limit is None or limit > 0:
+            if limit is None or limit >= len(self.buffer):
+                view = self.buffer
+            else:
+                view = self.buffer[:limit]
+            start = time.perf_counter()
+            n = f.readinto(view)
+            self.seconds += time.perf_counter() - start
+            self.reads += 1
+            if not n:
+                break
+            digest.update(view[:n])
+            if limit is not None:
+                limit -= n
+
+def MD5(filename, block_size=File.DefaultMD5Chunk):
+    """
+    Compute the MD5 of a file. For one-off use: anything doing lots of
+    files should keep a Hasher, and hence its buffer, to hand.
+    """
+    return Hasher('md5', block_size).Digest(filename)
+
+
+class PathResolver:
+    """
+    Turns directory IDs into full paths in bulk. Rather than a query
+    per ancestor of each directory, the (parent, name) of every
+    directory in a job is loaded in one query the first time any of
+    them is asked for. There are vastly fewer directories than files,
+    so it is reasonable to hold these in memory. Paths are memoised as
+    they are built, so the common prefixes of a tree are only ever
+    joined once.
+    """
+
+    IDsPerQuery = 1000 # For finding which jobs unknown IDs belong to
+
+    def __init__(self, session):
+        self.session = session
+        self.names = {} # dirid: (parent, name)
+        self.paths = {} # dirid: path, filled in as they are asked for
+        self.jobs = {} # job_id: IDs of its directories
+
+    def Load(self, job_id):
+        """
+        Read the directories of a job, if we haven't already
+        """
+        if job_id in self.jobs:
+            return
+        (root,) = self.session.query(Job.path).filter(Job.id == job_id).one()
+        rows = self.session.query(Directory.id, Directory.parent, Directory.name).filter(
+                Directory.job_id == job_id)
+        self.Add(job_id, root, rows)
+        logging.debug("Loaded {} directories of job {}".format(len(self.jobs[job_id]), job_id))
+
+    def Add(self, job_id, root, rows):
+        """
+        Add (ID, parent, name) rows for directories of a job whose top
+        is root. Used by Load, or to resolve paths from somewhere other
+        than the DB.
+        """
+        dirids = self.jobs.setdefault(int(job_id), [])
+        for dirid, parent, name in rows:
+            dirid = int(dirid)
+            self.names[dirid] = (parent, name)
+            dirids.append(dirid)
+            if parent is None:
+                self.paths[dirid] = os.path.normpath(root)
+
+    def Find(self, dirids):
+        """
+        Load the jobs of any of dirids we don't know about yet
+        """
+        unknown = sorted({int(d) for d in dirids} - self.names.keys())
+        for i in range(0, len(unknown), PathResolver.IDsPerQuery):
+            chunk = [d for d in unknown[i:i + PathResolver.IDsPerQuery] if d not in self.names]
+            if not chunk: # Loaded along with an earlier chunk
+                continue
+            for (job_id,) in self.session.query(Directory.job_id).filter(
+                    Directory.id.in_(chunk)).distinct():
+                self.Load(job_id)
+
+    def Path(self, dirid):
+        """
+        Full path of a directory, which must be in a job already loaded
+        """
+        dirid = int(dirid)
+        trail = []
+        node = dirid
+        while node not in self.paths:
+            trail.append(node)
+            node = self.names[node][0]
+        for d in reversed(trail):
+            parent, name = self.names[d]
+            self.paths[d] = os.path.join(self.paths[parent], name)
+        return self.paths[dirid]
+
+    def Paths(self, dirids):
+        """
+        Full paths of any number of directories, from any jobs
+        """
+        self.Find(dirids)
+        return [self.Path(d) for d in dirids]
+
+    def Job(self, job_id):
+        """
+        Returns a dict mapping the ID of every directory in a job to
+        its full path
+        """
+        self.Load(job_id)
+        return {dirid: self.Path(dirid) for dirid in self.jobs[job_id]}
+
+
+# Settings for a local SQLite inventory. WAL means readers (e.g. the
+# walkers looking up a previous job) aren't blocked by the writer, and
+# with it synchronous=NORMAL is still safe against a crash, though not
+# a power cut, without an fsync on every commit.
+LocalPragmas = (
+    'journal_mode=WAL',
+    'synchronous=NORMAL',
+    'foreign_keys=ON',
+    'temp_store=MEMORY',
+    'cache_size=-262144', # KiB, so 256 MiB
+    'busy_timeout=60000', # ms
+)
+
+def LocalEngine(path, echo=False):
+    """
+    An engine for an inventory kept in a local SQLite file, so a scan
+    needn't wait on the network (or have one). See ImportInventory.py
+    for getting it in to the central DB afterwards.
+    """
+    engine = create_engine('sqlite:///{}'.format(path), echo=echo)
+
+    @event.listens_for(engine, 'connect')
+    def SetPragmas(connection, record):
+        cursor = connection.cursor()
+        for pragma in LocalPragmas:
+            cursor.execute('pragma {}'.format(pragma))
+        cursor.close()
+
+    return engine
+
 
 def GetArgs():
     """
@@ -157,8 +726,8 @@ def GetArgs():
     ap.add_argument('--connector',   '-c', help='DB connector', default='mysql+mysqlconnector')
     ap.add_argument('--nuke',        '-n', help='Drop DB tables and restart', action='store_true')
     ap.add_argument('--md5sum',      '-m', help='Compute MD5 sum for each file', action='store_true')
-    ex.add_argument('--chunk-size',  '-g', help='Chunk size for computing MD5', default = File.DefaultMD5Chunk)
-    ex.add_argument('--commit-rec',  '-r', help='Max records after which to commit', default = File.MaxCommitRecords)
+    ex.add_argument('--chunk-size',  '-g', help='Chunk size for computing MD5', type=int, default = File.DefaultMD5Chunk)
+    ex.add_argument('--commit-rec',  '-r', help='Max records after which to commit', type=int, default = File.MaxCommitRecords)
     ex.add_argument('--verbose',     '-v', help='Verbosity', action='count')
 
     ap.add_argument('dirs', metavar ='directory', help='Directory to scan', nargs='*', default=[os.getcwd()])
@@ -9,3 +9,18 @@ with recursive tree as (
 	select d.id, d.name, d.parent from directory d, tree t
 	where t.parent = d.id
 ) select group_concat(name order by id separator '/') from tree ;
+
+/*
+** The same for many files at once: each row of the tree carries the
+** directory it started from, so the names can be grouped back together.
+** (Which is what FileInventory.PathResolver does in Python, but this is
+** handy at the mysql prompt.)
+*/
+
+with recursive tree as (
+	select d.id as leaf, 0 as depth, d.name, d.parent from directory d where d.id in
+	(select parent from file where id in (3790, 3791, 4012))
+	union all
+	select t.leaf, t.depth + 1, d.name, d.parent from directory d, tree t
+	where t.parent = d.id
+) select leaf, group_concat(name order by depth desc separator '/') from tree group by leaf ;
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""
+Computes checksums of inventoried files as a separate stage from the
+walk. Reading every file is vastly slower than merely stat'ing it, so
+rather than stall the walk while each file is read, hashing is done by
+a pool of worker processes, sized independently of the walkers, and
+the results are written back to the file table in batches.
+
+Run as a script it fills in the checksums of files already inventoried
+for a given job, e.g. one run without --md5sum, or one where the
+hashing fell behind the walk.
+
+On shared storage the hashing can be held to a budget of MB/s and
+reads/s (see Throttle), so it can run alongside everyone else.
+"""
+
+import os
+import time
+import heapq
+import bisect
+import signal
+import argparse
+import getpass
+import logging
+import itertools
+import threading
+import multiprocessing
+import concurrent.futures
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import sqlalchemy.exc
+
+import FileInventory
+import InventoryWriter
+import InventoryStats
+
+
+WorkerHasher = None # Each worker process's FileInventory.Hasher
+
+def InitWorker(algorithm, block_size):
+    """
+    Runs in each worker process, so the read buffer is allocated
+    once per process rather than once per file
+    """
+    global WorkerHasher
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C is the parent's business
+    WorkerHasher = FileInventory.Hasher(algorithm, block_size)
+
+def Measured(path, head=None):
+    """
+    Runs in a worker process to checksum a file (or just the ends
+    of it, see FileInventory.Hasher.Digest). Returns the digest, how
+    many reads it took and how long they took between them, for
+    Throttle, and how long it took altogether, so the time reading
+    can be told from the time computing (see HashPool.Measure).
+    """
+    start = time.perf_counter()
+    digest = WorkerHasher.Digest(path, head)
+    return digest, WorkerHasher.reads, WorkerHasher.seconds, time.perf_counter() - start
+
+
+class Throttle:
+    """
+    Paces the hashing to a budget of bytes and/or reads (IOPS) per
+    second, so that it can go on in the background on shared storage
+    without crowding out everyone else, and slows it down further
+    when reads start taking longer, which means the disks are busy.
+
+    Pacing is by a virtual clock: starting a file moves on the time at
+    which the next may start by what the file costs of the budget. So
+    a big file is still read as fast as the disks will go, but nothing
+    else is started until the budget has caught up with it.
+
+    Reads are timed by the workers (see FileInventory.Hasher). Reads
+    of small and large files take very different times, so a running
+    average is kept for each size bucket. If any average goes above
+    latency (by default Backoff times the best it has been, but
+    never less than Floor, as reads that quick are from cache), the
+    budget is halved, down to MinScale of what was asked for, and once
+    reads are quick again it is raised a Step at a time. Changes are
+    at least Settle seconds apart, to give them time to take effect.
+    """
+
+    Buckets   = (1<<16, 1<<24) # Up to 64 KiB, up to 16 MiB, and bigger
+    Backoff   = 3.0
+    MinScale  = 1/16
+    Step      = 1/16
+    Settle    = 2.0 # Seconds
+    Floor     = 0.002 # Seconds per read
+    Smoothing = 0.05 # Weight of each file in the running averages
+
+    def __init__(self, rate=None, iops=None, latency=None, block_size=FileInventory.File.DefaultMD5Chunk):
+        self.rate = rate # Bytes per second
+        self.iops = iops
+        self.latency = latency # Seconds per read
+        self.block_size = block_size
+        self.scale = 1.0 # Fraction of the budget we are using
+        self.next = time.monotonic() # When the next file may be started
+        self.changed = self.next
+        self.averages = {} # Size bucket: seconds per read
+        self.best = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def Bucket(size):
+        return bisect.bisect_right(Throttle.Buckets, size or 0)
+
+    @staticmethod
+    def Key(size, parent=None, within=None):
+        """
+        The order to read files in: the smallest size bucket first, as
+        that gets the most files done for the budget, then a directory
+        at a time. Within a directory the walk, which has them for
+        free, gives inode order, which for most filesystems is near
+        enough the order the data is on the disks, so cuts down seeks.
+        Files from the DB go in name order instead, as getting their
+        inodes would take a stat each, outside the budget.
+        """
+        return (Throttle.Bucket(size), parent or 0, within or 0)
+
+    def Wait(self):
+        """
+        Wait until the budget allows another file to be started
+        """
+        with self.lock:
+            delay = self.next - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def Charge(self, size):
+        """
+        Account for starting to read size bytes
+        """
+        size = size or 0
+        reads = 1 + size // self.block_size
+        cost = max(size / self.rate if self.rate else 0, reads / self.iops if self.iops else 0)
+        with self.lock:
+            self.next = max(self.next, time.monotonic()) + cost / self.scale
+
+    def Observe(self, size, reads, seconds):
+        """
+        A file of size bytes took reads reads and seconds seconds to hash
+        """
+        if not reads:
+            return
+        bucket = Throttle.Bucket(size)
+        latency = seconds / reads
+        with self.lock:
+            average = self.averages.get(bucket, latency)
+            average += Throttle.Smoothing * (latency - average)
+            self.averages[bucket] = average
+            best = self.best[bucket] = min(self.best.get(bucket, average), average)
+            now = time.monotonic()
+            if now - self.changed < Throttle.Settle:
+                return
+            if average > (self.latency or max(Throttle.Backoff * best, Throttle.Floor)):
+                if self.scale > Throttle.MinScale:
+                    self.scale = max(self.scale / 2, Throttle.MinScale)
+                    self.changed = now
+                    logging.info("Reads taking {:.2f} ms, slowing hashing to {:.0%} of its budget".format(
+                            1000 * average, self.scale))
+            elif self.scale < 1:
+                self.scale = min(self.scale + Throttle.Step, 1)
+                self.changed = now
+                logging.debug("Hashing back up to {:.0%} of its budget".format(self.scale))
+
+
+def MakeThrottle(rate=None, iops=None, latency=None, block_size=FileInventory.File.DefaultMD5Chunk):
+    """
+    A Throttle from command line arguments (rate in MB/s, latency in
+    milliseconds), or None if there is no budget to keep to
+    """
+    if not (rate or iops):
+        if latency:
+            logging.warning("--max-latency needs --max-rate or --max-iops to slow down from")
+        return None
+    return Throttle(rate * 2**20 if rate else None, iops, latency / 1000 if latency else None, block_size)
+
+
+class HashPool:
+    """
+    A pool of processes computing checksums. Jobs are (file id, path,
+    size) and results are put on a queue as ('digest', row) tuples for
+    the DB writer. What gets hashed is counted in stats (an
+    InventoryStats.Stats), which can watch the backlog too.
+
+    Given a throttle, files submitted wait in a queue, best first by
+    Throttle.Key, for a thread which starts them as fast as the
+    throttle allows, so the walk is never held up by it.
+    """
+
+    MaxBacklog = 10000 # Files waiting to be hashed
+
+    def __init__(self, workers=None, algorithm='md5', block_size=FileInventory.File.DefaultMD5Chunk,
+                 backlog=MaxBacklog, wait=False, stats=None, throttle=None):
+        # Spawn rather than fork, as we are started from a process with
+        # threads running and forking those can deadlock
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=InitWorker, initargs=(algorithm, block_size))
+        self.algorithm = algorithm
+        self.empty = FileInventory.Digests[algorithm]().hexdigest()
+        self.backlog = backlog
+        self.wait = wait # For when there is no DB to catch up from later
+        self.pending = 0
+        self.cancelled = False
+        self.idle = threading.Condition()
+        self.stats = stats or InventoryStats.Stats()
+        self.stats.Gauge('hash_backlog', lambda: self.pending)
+        self.throttle = throttle
+        self.queue = [] # Waiting for the throttle: (key, order, file_id, path, size, results)
+        self.order = itertools.count() # So files with the same key go in the order they came
+        self.closed = False
+        if throttle:
+            self.stats.Gauge('hash_throttle', lambda: throttle.scale)
+            threading.Thread(target=self.Dispatch, daemon=True).start()
+
+    def Submit(self, file_id, path, size, results, parent=None, inode=None):
+        """
+        Queue a file for hashing without waiting. Returns False if the
+        backlog is full, in which case the file is left for a later
+        pass (see HashJob) rather than holding up the caller, unless
+        the pool was made with wait, when we wait for room instead.
+        parent and inode are for ordering reads if we are throttled.
+        """
+        if size == 0: # No need to bother the disks
+            results.put(('digest', dict(file_id=file_id, digest=self.empty)))
+            self.stats.Add('hashed')
+            return True
+        with self.idle:
+            if self.wait:
+                self.idle.wait_for(lambda: self.pending < self.backlog or self.cancelled)
+            if self.pending >= self.backlog or self.cancelled:
+                self.stats.Add('hash_skipped')
+                return False
+            self.pending += 1
+            if self.throttle:
+                heapq.heappush(self.queue, (Throttle.Key(size, parent, inode), next(self.order),
+                                            file_id, path, size, results))
+                self.idle.notify_all()
+                return True
+        self.Start(file_id, path, size, results)
+        return True
+
+    def Start(self, file_id, path, size, results):
+        """
+        Hand a file to the workers
+        """
+        future = self.executor.submit(Measured, path)
+        future.add_done_callback(lambda f: self.Done(f, file_id, size, results))
+
+    def Dispatch(self):
+        """
+        Thread body if we are throttled: start the best of the files
+        waiting whenever the throttle allows
+        """
+        while True:
+            self.throttle.Wait()
+            with self.idle:
+                self.idle.wait_for(lambda: self.queue or self.closed or self.cancelled)
+                if self.closed or self.cancelled:
+                    return
+                _, _, file_id, path, size, results = heapq.heappop(self.queue)
+            self.throttle.Charge(size)
+            try:
+                self.Start(file_id, path, size, results)
+            except RuntimeError: # Shut down under us
+                return
+
+    def Done(self, future, file_id, size, results):
+        """
+        Callback when a file has been hashed
+        """
+        try:
+            if future.cancelled():
+                return
+            digest = self.Measure(size, future.result())
+            if digest:
+                results.put(('digest', dict(file_id=file_id, digest=digest)))
+                counter = self.stats.Counter()
+                counter['hashed'] += 1
+                counter['hashed_bytes'] += size
+            else:
+                self.stats.Add('hash_errors')
+        except Exception as e:
+            self.stats.Add('hash_errors')
+            logging.error("Error hashing file {}: {}".format(file_id, e))
+        finally:
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+
+    def Wait(self):
+        """
+        Wait for everything submitted so far to be hashed
+        """
+        with self.idle:
+            self.idle.wait_for(lambda: self.pending == 0 or self.cancelled)
+
+    def Map(self, paths, head=None, sizes=None):
+        """
+        Hash a batch of paths, waiting for the results, which are
+        returned in the same order. If we are throttled, each is
+        started when the throttle allows, charged for its size (so
+        pass sizes, and put the paths in Throttle.Key order).
+        """
+        if not self.throttle:
+            return [self.Measure(None, measured) for measured in
+                    self.executor.map(Measured, paths, itertools.repeat(head), chunksize=16)]
+        futures = []
+        for path, size in zip(paths, sizes or itertools.repeat(None)):
+            if head and size:
+                size = min(size, 2 * head)
+            self.throttle.Wait()
+            self.throttle.Charge(size)
+            future = self.executor.submit(Measured, path, head)
+            future.add_done_callback(lambda f, size=size: self.Observe(f, size))
+            futures.append(future)
+        return [future.result()[0] for future in futures]
+
+    def Observe(self, future, size):
+        """
+        Callback when a file from Map has been hashed
+        """
+        if not future.cancelled() and future.exception() is None:
+            self.Measure(size, future.result())
+
+    def Measure(self, size, measured):
+        """
+        Count the time a file took to hash (hash), and how much of it
+        was reading (hash_read), and tell the throttle if there is one.
+        Returns the digest.
+        """
+        digest, reads, seconds, elapsed = measured
+        self.stats.Spent('hash', elapsed)
+        self.stats.Spent('hash_read', seconds)
+        if self.throttle:
+            self.throttle.Observe(size, reads, seconds)
+        return digest
+
+    def Cancel(self):
+        """
+        Abandon anything not yet hashed, e.g. on Ctrl-C
+        """
+        with self.idle:
+            self.cancelled = True
+            self.pending -= len(self.queue)
+            self.queue = []
+            self.idle.notify_all()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def Close(self):
+        with self.idle:
+            self.closed = True
+            self.idle.notify_all()
+        self.executor.shutdown()
+
+
+def HashJob(writer, pool, job_id):
+    """
+    Compute checksums for all the files in a job which don't yet have
+    one. Files are fetched in batches in ID order, so the whole of a
+    job's file table is never in memory at once.
+
+    Note that names are sanitised when they are inventoried, so files
+    with really exotic names may no longer be found.
+    """
+    session = writer.session
+    job = session.query(FileInventory.Job).get(job_id)
+    if job is None:
+        logging.error("No such job {}".format(job_id))
+        return
+    if job.digest and job.digest != pool.algorithm:
+        logging.error("Job {} already uses {}, not {}".format(job_id, job.digest, pool.algorithm))
+        return
+    job.digest = pool.algorithm
+    session.commit()
+    paths = FileInventory.PathResolver(session)
+    paths.Load(job_id)
+    file = FileInventory.File
+    last = -1
+    while True:
+        rows = session.query(file.id, file.parent, file.name, file.size).join(
+                FileInventory.Directory, FileInventory.Directory.id == file.parent).filter(
+                FileInventory.Directory.job_id == job_id, file.md5sum.is_(None),
+                file.id > last).order_by(file.id).limit(writer.batch_size).all()
+        if not rows:
+            break
+        logging.info("Hashing {} files from ID {}".format(len(rows), rows[0].id))
+        last = rows[-1].id
+        files = [(r, os.path.join(paths.Path(r.parent), r.name)) for r in rows]
+        if pool.throttle: # Read them in the order kindest to the disks
+            files.sort(key=lambda f: Throttle.Key(f[0].size, f[0].parent, f[0].name))
+        rows = [r for r, _ in files]
+        digests = pool.Map([path for _, path in files], sizes=[r.size for r in rows])
+        counter = pool.stats.Counter()
+        for r, digest in zip(rows, digests):
+            if digest:
+                writer.AddDigest(r.id, digest)
+                counter['hashed'] += 1
+                counter['hashed_bytes'] += r.size or 0
+            else:
+                counter['hash_errors'] += 1
+        writer.Flush()
+
+
+def GetArgs():
+    """
+    Process command line arguments
+    """
+    ap = argparse.ArgumentParser(description='Compute checksums of inventoried files')
+    gr = ap.add_mutually_exclusive_group()
+    ex = ap.add_argument_group(title='Exotic', description='Here be dragons')
+    ap.add_argument('--host',         '-t', help='DB hostname or IP address', default='merlin')
+    ap.add_argument('--user',         '-u', help='DB username', default='tim')
+    gr.add_argument('--password',     '-p', help='DB password')
+    gr.add_argument('--blank',        '-b', help='Permit blank password', action='store_true')
+    ap.add_argument('--schema',       '-s', help='DB schema', default='inventory')
+    ap.add_argument('--connector',    '-c', help='DB connector', default='mysql+mysqlconnector')
+    ap.add_argument('--local',        '-l', help='Use this SQLite file rather than the DB server', metavar='FILE')
+    ap.add_argument('--digest',       '-a', help='Checksum algorithm', default='md5',
+                    choices=sorted(FileInventory.Digests))
+    ap.add_argument('--max-rate',     '-x', help='Read no more than this many MB/s', type=float)
+    ap.add_argument('--max-iops',     '-y', help='Make no more than this many reads/s', type=float)
+    ex.add_argument('--max-latency',  '-Y', help='Slow down if reads take longer than this many ms '
+                    '(default: when they take {} times as long as at best)'.format(Throttle.Backoff), type=float)
+    ex.add_argument('--hash-workers', '-H', help='Number of processes computing checksums', type=int)
+    ex.add_argument('--chunk-size',   '-g', help='Chunk size for computing checksums', type=int,
+                    default=FileInventory.File.DefaultMD5Chunk)
+    ex.add_argument('--commit-rec',   '-r', help='Max records after which to commit', type=int,
+                    default=FileInventory.File.MaxCommitRecords)
+    ex.add_argument('--sql-debug',    '-q', help='Print details of SQL commands', action='store_true')
+    ex.add_argument('--verbose',      '-v', help='Verbosity', action='count')
+
+    ap.add_argument('jobs', metavar='job', help='ID of job to compute checksums for', type=int, nargs='+')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = GetArgs()
+    while not (args.blank or args.password or args.local): # Prompt for a password if required
+        args.password = getpass.getpass()
+
+    if not args.verbose: # Is None if not specified
+        args.verbose = 0
+
+    loglevels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    level = loglevels[min(args.verbose, len(loglevels)- 1)]
+    logging.basicConfig(level = level, format = '%(asctime)s %(message)s')
+
+    if args.password:
+        connectstr = '{}://{}:{}@{}/{}'.format(args.connector, args.user,
+                      args.password, args.host, args.schema)
+    else:
+        connectstr = '{}://{}@{}/{}'.format(args.connector, args.user,
+                      args.host, args.schema)
+
+    try:
+        if args.local:
+            engine = FileInventory.LocalEngine(args.local, echo = True if args.sql_debug else False)
+        else:
+            engine = create_engine(connectstr, pool_recycle=3600,
+                                   echo = True if args.sql_debug else False)
+    except sqlalchemy.exc.NoSuchModuleError as e:
+        logging.critical("Error creating engine: {}".format(e))
+    else:
+        FileInventory.Layout.Setup(engine)
+        session = sessionmaker(bind=engine)()
+        writer = InventoryWriter.BatchWriter(session, args.commit_rec)
+        pool = HashPool(args.hash_workers, args.digest, args.chunk_size,
+                        throttle=MakeThrottle(args.max_rate, args.max_iops, args.max_latency, args.chunk_size))
+        try:
+            for job_id in args.jobs:
+                HashJob(writer, pool, job_id)
+        except KeyboardInterrupt:
+            logging.error("Job interrupted by user!")
+        writer.Close()
+        pool.Close()
+        session.close()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Copies jobs from a local SQLite inventory (see PerformInventory.py
+--local) in to the central DB.
+
+Scanning straight in to a DB at the far end of a network pays the
+round trip on every batch, and can't be done at all when the network
+isn't there. So scan to a local file, then bring the finished jobs
+over in bulk with this, reading and writing a batch at a time.
+
+A job is given a new ID in the central DB. As directory and file IDs
+are derived from the job ID (see Directory.MakeID), all that needs
+to be done to them is to add the same offset to every one.
+
+Either DB can have either layout (see FileInventory.Layout): files
+are turned in to the wide layout as they are read and back in to the
+compact one, if need be, as they are written.
+"""
+
+import argparse
+import getpass
+import logging
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+import sqlalchemy.exc
+
+import FileInventory
+import InventoryWriter
+
+
+class Importer:
+    """
+    Copies jobs from one inventory DB to another, remembering what
+    each was given as its new ID, so that an incremental job imported
+    after the one it was based on still refers to it.
+    """
+
+    def __init__(self, source, writer):
+        self.source = source
+        self.writer = writer
+        self.session = writer.session
+        self.jobs = {} # Local job ID: central job ID
+        self.interner = None # For the source, if it has the compact layout
+
+    def Rows(self, table, where, key):
+        """
+        Generates the rows of a table in batches, in order of key,
+        so the whole table is never in memory at once
+        """
+        last = None
+        while True:
+            query = select([table]).where(where).order_by(key).limit(self.writer.batch_size)
+            if last is not None:
+                query = query.where(key > last)
+            rows = [dict(row) for row in self.source.execute(query)]
+            if not rows:
+                break
+            last = rows[-1][key.name] # Before the caller alters them
+            yield rows
+
+    def Copy(self, table, where, key, Move, what, Convert=None):
+        """
+        Copy rows of a table a batch at a time, each row altered by
+        Move and then, if given, each batch by Convert
+        """
+        number = 0
+        for rows in self.Rows(table, where, key):
+            for row in rows:
+                Move(row)
+            if Convert:
+                rows = Convert(rows)
+            self.writer.Execute(table.insert(), rows, what)
+            number += len(rows)
+        logging.info("Copied {:,} {} rows".format(number, what))
+
+    def ConvertFiles(self, rows):
+        """
+        Turn file rows from the source's layout in to the destination's
+        """
+        if FileInventory.Layout.Compact(self.source.dialect):
+            if self.interner is None:
+                self.interner = FileInventory.Interner(self.source)
+            self.interner.Decode(rows)
+        return self.writer.Compact(rows)
+
+    def Import(self, job_id):
+        """
+        Copy a job, with its directories, files, rollups and changes
+        """
+        job = FileInventory.Job.__table__
+        directory = FileInventory.Directory.__table__
+        file = FileInventory.File.__table__
+        rollup = FileInventory.Rollup.__table__
+        change = FileInventory.Change.__table__
+        row = self.source.execute(select([job]).where(job.c.id == job_id)).first()
+        if row is None:
+            logging.error("No such job {}".format(job_id))
+            return
+        if row.ended is None:
+            logging.error("Job {} hasn't finished, so carry on with it (--resume) first".format(job_id))
+            return
+        row = dict(row)
+        del row['id']
+        ended = row['ended']
+        row['ended'] = None # Until it's all there
+        previous = row['previous']
+        if previous is not None and previous not in self.jobs:
+            logging.warning("Job {} was based on job {} which hasn't been imported, "
+                            "so its changes won't be".format(job_id, previous))
+        row['previous'] = self.jobs.get(previous)
+        new = self.session.execute(job.insert(), row).inserted_primary_key[0]
+        self.session.commit()
+        self.jobs[job_id] = new
+        logging.info("Importing job {} as {}".format(job_id, new))
+
+        offset = (new - job_id) * FileInventory.Directory.IDBlock
+
+        def MoveDirectory(row):
+            row['id'] += offset
+            row['job_id'] = new
+            if row['parent'] is not None:
+                row['parent'] += offset
+
+        def MoveFile(row):
+            row['id'] += offset
+            row['parent'] += offset
+
+        def MoveRollup(row):
+            row['directory_id'] += offset
+            row['job_id'] = new
+
+        # Deleted files and directories are those of the previous job
+        before = (self.jobs[previous] - previous) * FileInventory.Directory.IDBlock if previous in self.jobs else 0
+
+        def MoveChange(row):
+            del row['id']
+            row['job_id'] = new
+            shift = before if row['kind'] == FileInventory.Change.Deleted else offset
+            for column in ('file_id', 'directory_id'):
+                if row[column] is not None:
+                    row[column] += shift
+
+        first = FileInventory.File.MakeID(job_id, 0)
+        self.Copy(directory, directory.c.job_id == job_id, directory.c.id, MoveDirectory, 'directory')
+        self.Copy(file, file.c.id.between(first, first + FileInventory.File.IDBlock - 1), file.c.id,
+                  MoveFile, 'file', self.ConvertFiles)
+        self.Copy(rollup, rollup.c.job_id == job_id, rollup.c.directory_id, MoveRollup, 'rollup')
+        if previous is None or previous in self.jobs:
+            self.Copy(change, change.c.job_id == job_id, change.c.id, MoveChange, 'change')
+        self.session.execute(job.update().where(job.c.id == new).values(ended=ended))
+        self.session.commit()
+
+
+def GetArgs():
+    """
+    Process command line arguments
+    """
+    ap = argparse.ArgumentParser(description='Copy jobs from a local inventory to the DB')
+    gr = ap.add_mutually_exclusive_group()
+    ex = ap.add_argument_group(title='Exotic', description='Here be dragons')
+    ap.add_argument('--host',         '-t', help='DB hostname or IP address', default='merlin')
+    ap.add_argument('--user',         '-u', help='DB username', default='tim')
+    gr.add_argument('--password',     '-p', help='DB password')
+    gr.add_argument('--blank',        '-b', help='Permit blank password', action='store_true')
+    ap.add_argument('--schema',       '-s', help='DB schema', default='inventory')
+    ap.add_argument('--connector',    '-c', help='DB connector', default='mysql+mysqlconnector')
+    ex.add_argument('--commit-rec',   '-r', help='Max records after which to commit', type=int,
+                    default=FileInventory.File.MaxCommitRecords)
+    ex.add_argument('--sql-debug',    '-q', help='Print details of SQL commands', action='store_true')
+    ex.add_argument('--verbose',      '-v', help='Verbosity', action='count')
+
+    ap.add_argument('local', metavar='file', help='SQLite file written by PerformInventory.py --local')
+    ap.add_argument('jobs', metavar='job', help='Jobs to copy (default all finished ones)', type=int, nargs='*')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = GetArgs()
+    while not (args.blank or args.password): # Prompt for a password if required
+        args.password = getpass.getpass()
+
+    if not args.verbose: # Is None if not specified
+        args.verbose = 0
+
+    loglevels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    level = loglevels[min(args.verbose, len(loglevels)- 1)]
+    logging.basicConfig(level = level, format = '%(asctime)s %(message)s')
+
+    if args.password:
+        connectstr = '{}://{}:{}@{}/{}'.format(args.connector, args.user,
+                      args.password, args.host, args.schema)
+    else:
+        connectstr = '{}://{}@{}/{}'.format(args.connector, args.user,
+                      args.host, args.schema)
+
+    try:
+        engine = create_engine(connectstr, pool_recycle=3600,
+                               echo = True if args.sql_debug else False)
+    except sqlalchemy.exc.NoSuchModuleError as e:
+        logging.critical("Error creating engine: {}".format(e))
+    else:
+        FileInventory.Layout.Setup(engine)
+        FileInventory.Base.metadata.create_all(engine, checkfirst = True)
+        local = FileInventory.LocalEngine(args.local)
+        FileInventory.Layout.Setup(local)
+        source = local.connect()
+        session = sessionmaker(bind=engine)()
+        importer = Importer(source, InventoryWriter.BatchWriter(session, args.commit_rec))
+        job = FileInventory.Job.__table__
+        jobs = args.jobs or [job_id for (job_id,) in source.execute(
+                select([job.c.id]).where(job.c.ended.isnot(None)).order_by(job.c.id))]
+        try:
+            for job_id in sorted(jobs): # So incremental jobs come after what they were based on
+                importer.Import(job_id)
+        except KeyboardInterrupt:
+            logging.error("Import interrupted by user!")
+        source.close()
+        session.close()
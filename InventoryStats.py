@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and timers for a running job, and a thread which reports them
+every so often, so that a scan lasting days can be watched: how fast it
+is going, where the time goes (listing directories, stat'ing files,
+checksumming, writing to the DB), how far behind the hashing is and,
+given how big the tree was last time, when it might finish.
+
+Counting has to cost next to nothing, as it is done for every file,
+from several threads at once. So each thread counts in a Counter of
+its own, without any locking, and only the reporting thread adds
+them all up.
+
+Counters used:
+
+    directories, files, bytes   found by the walk
+    scandir, stat               calls, and seconds in them (name_s)
+    walk_errors                 unreadable directories and files
+    unfinished                  directories which couldn't be read to the end
+    hashed, hashed_bytes        checksums computed
+    hash, hash_read             files read by the hashers, and seconds altogether and reading
+    hash_skipped, hash_errors   files left for later, or unreadable
+    flush, rows                 writer flushes (and seconds), rows written
+    db_wait                     handing batches to writer threads (and seconds)
+    db_retries, db_errors       batches retried (again or singly), rows dropped
+"""
+
+import json
+import time
+import logging
+import datetime
+import threading
+import collections
+
+
+class Stats:
+    """
+    Counters, and timers, which are a counter of calls plus one of
+    the seconds they took (name + '_s'), kept per thread. Gauges are
+    functions giving a value at the moment they are called, e.g. the
+    length of a queue.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.counters = [] # Every thread's Counter
+        self.lock = threading.Lock()
+        self.gauges = {}
+
+    def Counter(self):
+        """
+        The calling thread's Counter, to update directly in hot loops
+        """
+        try:
+            return self.local.counter
+        except AttributeError:
+            counter = self.local.counter = collections.Counter()
+            with self.lock:
+                self.counters.append(counter)
+            return counter
+
+    def Add(self, name, n=1):
+        self.Counter()[name] += n
+
+    def Time(self, name, start):
+        """
+        Count a call to name which began at start (by time.perf_counter)
+        and has just finished
+        """
+        self.Spent(name, time.perf_counter() - start)
+
+    def Spent(self, name, seconds):
+        """
+        Count a call to name which took seconds, timed by the caller
+        (e.g. in another process)
+        """
+        counter = self.Counter()
+        counter[name] += 1
+        counter[name + '_s'] += seconds
+
+    def Gauge(self, name, Function):
+        self.gauges[name] = Function
+
+    def Totals(self):
+        """
+        All the threads' counters added up
+        """
+        with self.lock:
+            counters = list(self.counters)
+        totals = collections.Counter()
+        for counter in counters:
+            totals.update(dict(counter)) # Copied in one go, as its thread may be updating it
+        return totals
+
+    @staticmethod
+    def Summary(totals):
+        """
+        What is kept in the job table (see FileInventory.Job)
+        """
+        return dict(files=totals['files'], directories=totals['directories'], bytes=totals['bytes'],
+                    hashed=totals['hashed'], hashed_bytes=totals['hashed_bytes'],
+                    errors=totals['walk_errors'] + totals['hash_errors'] + totals['db_errors'])
+
+
+class Progress:
+    """
+    A thread which every interval seconds logs the totals so far, the
+    rates since last time, the average time taken by each timer and
+    the gauges (e.g. hash_backlog, the files waiting to be hashed), as
+    key=value pairs. If path is given the same goes on the end of it as
+    a line of JSON. If expected (the number of files there were last
+    time) is given we guess when we will finish.
+
+    Only what happened since Progress was made is counted, so the
+    same Stats can be carried on from job to job.
+    """
+
+    Timers = ('scandir', 'stat', 'hash', 'hash_read', 'flush', 'db_wait')
+
+    def __init__(self, stats, interval=60, path=None, expected=None):
+        self.stats = stats
+        self.interval = interval
+        self.path = path
+        self.expected = expected
+        self.base = stats.Totals()
+        self.last = collections.Counter()
+        self.started = self.then = time.time()
+        self.stop = threading.Event()
+        self.thread = None
+
+    def Start(self):
+        if self.interval:
+            self.thread = threading.Thread(target=self.Run, daemon=True)
+            self.thread.start()
+        return self
+
+    def Run(self):
+        while not self.stop.wait(self.interval):
+            self.Report()
+
+    def Totals(self):
+        """
+        Counted since we started
+        """
+        return self.stats.Totals() - self.base
+
+    def Report(self, final=False):
+        """
+        Log (and maybe write) where we have got to. Rates are since the
+        last report, except in the final one, where they are overall.
+        """
+        now = time.time()
+        totals = self.Totals()
+        since, self.last = totals - self.last, totals
+        seconds, self.then = max(now - self.then, 1e-9), now
+        elapsed = now - self.started
+        if final:
+            since, seconds = totals, max(elapsed, 1e-9)
+        report = {'time': datetime.datetime.fromtimestamp(now).isoformat(timespec='seconds'),
+                  'elapsed': round(elapsed, 1)}
+        report.update((name, int(totals[name]) if isinstance(totals[name], int) else round(totals[name], 3))
+                      for name in sorted(totals))
+        for name in ('files', 'bytes', 'hashed', 'hashed_bytes', 'rows'):
+            report[name + '_per_s'] = round(since[name] / seconds, 1)
+        for name in Progress.Timers:
+            if since[name]:
+                report[name + '_ms'] = round(1000 * since[name + '_s'] / since[name], 3)
+        for name, Gauge in self.stats.gauges.items():
+            report[name] = Gauge()
+        if self.expected and not final:
+            rate = totals['files'] / elapsed if elapsed else 0
+            left = max(self.expected - totals['files'], 0)
+            if rate:
+                report['eta'] = (datetime.datetime.fromtimestamp(now) + datetime.timedelta(
+                        seconds=left / rate)).isoformat(timespec='seconds')
+        logging.info("{} {}".format('Summary' if final else 'Progress',
+                                    ' '.join('{}={}'.format(k, v) for k, v in report.items())))
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(report, final=final)) + '\n')
+        return totals
+
+    def Stop(self):
+        """
+        Stop reporting, with a final report. Returns the totals.
+        """
+        self.stop.set()
+        if self.thread:
+            self.thread.join()
+        return self.Report(final=True)
@@ -0,0 +1,652 @@
+# -*- coding: utf-8 -*-
+"""
+Buffered writer for the inventory DB.
+
+Rather than adding and committing an ORM object per file (one DB round
+trip each, which on ~ 10**8 files makes the DB the bottleneck long
+before the disks), rows are collected in plain dicts and written with
+a single Core-level executemany once enough have accumulated.
+
+Directory IDs are allocated by the scanner (see Directory.MakeID) so
+directory rows can be batched in the same way. They are always written
+ahead of the file rows in a batch, and arrive in parent-before-child
+order, so foreign keys are satisfied without a commit per directory.
+
+Checksums computed after the event (see HashInventory.py) are written
+back as batched updates, after any inserts they might refer to.
+
+An incremental scan can ask for all the files in an unchanged directory
+to be copied from the previous job. That is done in the DB with an
+INSERT ... SELECT, so the rows never come back to us at all.
+
+Once all of a directory's files have been written it is marked complete,
+which is what lets an interrupted job be resumed. Resuming purges the
+files of any directory which wasn't, before they are written again.
+
+Once the whole tree under a directory has been scanned, the scanner
+works out its totals (see FileInventory.Rollup), which are written last.
+
+AsyncWriter does the same, but leaves the writing to threads of its
+own, so the DB and the disks being scanned are kept busy at once.
+
+ColumnarWriter takes the place of BatchWriter when a scan is written
+straight to files for analysis, bypassing the DB altogether.
+"""
+
+import os
+import csv
+import gzip
+import time
+import queue
+import datetime
+import logging
+import threading
+import collections
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # Optional, for writing Parquet
+    pyarrow = None
+
+from sqlalchemy import bindparam, select, null
+from sqlalchemy.orm import sessionmaker
+import sqlalchemy.exc
+
+import FileInventory
+import InventoryStats
+
+
+# What the scanner hands over for each file: its name as it came from
+# os.scandir, and the raw st_* values. These are only turned in to
+# what the DB wants (see FileRows) a batch at a time, as they are
+# written, which saves a lot of per-file fuss in the walk.
+FileRecord = collections.namedtuple('FileRecord', ['id', 'serial', 'parent', 'name', 'atime', 'mtime', 'ctime',
+                                                   'mode', 'uid', 'gid', 'size', 'md5sum'])
+
+def FileRows(records):
+    """
+    Rows for the file table from a batch of FileRecords
+    """
+    names = FileInventory.File.CleanNames([r.name for r in records])
+    when = datetime.datetime.fromtimestamp
+    return [{'id': r.id, 'serial': r.serial, 'parent': r.parent, 'name': name,
+             'atime': when(r.atime), 'mtime': when(r.mtime), 'ctime': when(r.ctime),
+             'mode': r.mode, 'uid': r.uid, 'gid': r.gid, 'size': r.size, 'md5sum': r.md5sum}
+            for r, name in zip(records, names)]
+
+
+# What a flush writes: lists of rows (FileRecords for files), and the
+# copies of directories, split by whether their checksums go too
+Batch = collections.namedtuple('Batch', ['directories', 'purges', 'files', 'copies', 'changes', 'digests',
+                                         'done', 'rollups'])
+
+# Errors from MySQL (lock wait timeout, deadlock, server gone away, lost
+# connection) and Postgres (serialization failure, deadlock) which are
+# worth trying again
+TransientCodes = {1205, 1213, 2006, 2013, 2055, '40001', '40P01'}
+
+def Transient(error):
+    """
+    Whether a DBAPIError is one which may well not happen if the
+    same thing is tried again in a while
+    """
+    if error.connection_invalidated:
+        return True
+    orig = error.orig
+    args = getattr(orig, 'args', None) or [None]
+    codes = {getattr(orig, 'errno', None), getattr(orig, 'pgcode', None),
+             args[0] if isinstance(args[0], (int, str)) else None}
+    if codes & TransientCodes:
+        return True
+    # SQLite, busy for longer than its busy_timeout
+    return isinstance(error, sqlalchemy.exc.OperationalError) and 'database is locked' in str(orig)
+
+
+class WriterError(Exception):
+    """
+    A writer thread gave up on a batch for some reason other than the
+    DB (which has DBAPIError), e.g. a row it couldn't make sense of
+    """
+
+
+class BatchWriter:
+    """
+    Collects directory and file rows and flushes them to the DB in
+    batches of batch_size. If a batch fails because of the DB rather
+    than the rows (e.g. a deadlock, or the connection dropping), it is
+    tried again. If it fails for some other reason it is rolled back
+    and the rows are retried one at a time so that the offending
+    row(s) can be logged and dropped without losing the rest of the
+    batch.
+
+    How long flushes take, and how many rows are written, are counted
+    in stats (an InventoryStats.Stats).
+    """
+
+    Incremental = True # Can copy, change and purge, so be used for incremental scans and resuming
+    Retries = 8 # Of a batch after a transient error
+    Backoff = 0.5 # Seconds before the first retry, doubling each time
+    MaxBackoff = 60
+
+    def __init__(self, session, batch_size=FileInventory.File.MaxCommitRecords, stats=None):
+        self.session = session
+        self.batch_size = max(1, int(batch_size))
+        self.stats = stats or InventoryStats.Stats()
+        self.directories = []
+        self.files = []
+        self.digests = []
+        self.copies = {True: [], False: []}
+        self.changes = []
+        self.purges = []
+        self.done = []
+        self.rollups = []
+        self.interner = None # For the compact layout (see FileInventory.Layout)
+
+    def AddDirectory(self, **row):
+        """
+        Queue a row for the directory table. The row must carry its
+        own id, and its parent must already have been queued.
+        """
+        self.directories.append(row)
+        if len(self.directories) + len(self.files) >= self.batch_size:
+            self.Flush()
+
+    def AddFile(self, record):
+        """
+        Queue a FileRecord for the file table, flushing if the buffer
+        is full
+        """
+        self.files.append(record)
+        if len(self.directories) + len(self.files) >= self.batch_size:
+            self.Flush()
+
+    def AddCopy(self, prior, parent, offset, digests=True):
+        """
+        Queue copying the files in directory prior to directory parent.
+        offset is added to their IDs. Checksums are copied too unless
+        digests is False.
+        """
+        self.copies[digests].append({'prior': prior, 'new_parent': parent, 'offset': offset})
+        if len(self.copies[digests]) >= self.batch_size:
+            self.Flush()
+
+    def AddChange(self, job_id, kind, file_id=None, directory_id=None):
+        """
+        Queue a row for the change table
+        """
+        self.changes.append({'job_id': job_id, 'kind': kind, 'file_id': file_id, 'directory_id': directory_id})
+        if len(self.changes) >= self.batch_size:
+            self.Flush()
+
+    def AddPurge(self, job_id, dirid, prior=None):
+        """
+        Queue deleting whatever was written for a directory's files
+        (and changes to them) before a job was interrupted, and the
+        deletions recorded against prior, the same directory in the
+        previous job
+        """
+        self.purges.append({'purge_job': job_id, 'dirid': dirid, 'prior': prior})
+        self.Flush() # Rare, and must happen before its files are written again
+
+    def AddDone(self, dirid):
+        """
+        Queue marking a directory complete
+        """
+        self.done.append({'dirid': dirid})
+        if len(self.done) >= self.batch_size:
+            self.Flush()
+
+    def AddRollup(self, **row):
+        """
+        Queue a row for the rollup table
+        """
+        self.rollups.append(row)
+        if len(self.rollups) >= self.batch_size:
+            self.Flush()
+
+    def AddDigest(self, file_id, digest):
+        """
+        Queue an update of the checksum of an existing (or queued) file
+        """
+        self.digests.append({'file_id': file_id, 'digest': digest})
+        if len(self.digests) >= self.batch_size:
+            self.Flush()
+
+    def Take(self):
+        """
+        Everything buffered, as a Batch, leaving the buffers empty.
+        Returns None if there was nothing.
+        """
+        batch = Batch(self.directories, self.purges, self.files, self.copies, self.changes, self.digests,
+                      self.done, self.rollups)
+        self.directories, self.purges, self.files, self.changes = [], [], [], []
+        self.digests, self.done, self.rollups = [], [], []
+        self.copies = {True: [], False: []}
+        if any(batch._replace(copies=batch.copies[True] + batch.copies[False])):
+            return batch
+        return None
+
+    def Flush(self):
+        """
+        Write any buffered rows to the DB and commit. Directories go
+        first as the files refer to them, and checksums last as they
+        update the files.
+        """
+        start = time.perf_counter()
+        batch = self.Take()
+        if batch is None:
+            return
+        self.WriteDirectories(batch, self.session)
+        self.WriteFiles(batch, self.session)
+        self.WriteUpdates(batch, self.session)
+        self.stats.Time('flush', start)
+
+    def WriteDirectories(self, batch, session):
+        """
+        The first part of writing a batch: new directories, and
+        purges of what was written for incomplete ones
+        """
+        directory = FileInventory.Directory.__table__
+        file = FileInventory.File.__table__
+        change = FileInventory.Change.__table__
+        self.Execute(directory.insert(), batch.directories, 'directory', session)
+        # Deletions refer to the previous job's files and directories
+        self.Execute(change.delete().where(change.c.job_id == bindparam('purge_job')).where(
+                change.c.file_id.in_(select([file.c.id]).where(file.c.parent == bindparam('dirid'))) |
+                change.c.file_id.in_(select([file.c.id]).where(file.c.parent == bindparam('prior'))) |
+                change.c.directory_id.in_(select([directory.c.id]).where(directory.c.parent == bindparam('prior')))),
+                batch.purges, 'purge of changes', session)
+        self.Execute(file.delete().where(file.c.parent == bindparam('dirid')), batch.purges,
+                     'purge of directory', session)
+
+    def WriteFiles(self, batch, session):
+        """
+        The second part: files, copies of files and changes
+        """
+        self.Execute(FileInventory.File.__table__.insert(), self.Compact(FileRows(batch.files), session), 'file',
+                     session)
+        for keep, rows in batch.copies.items():
+            self.Execute(self.CopyStatement(keep), rows, 'copy of directory', session)
+        self.Execute(FileInventory.Change.__table__.insert(), batch.changes, 'change', session)
+
+    def WriteUpdates(self, batch, session):
+        """
+        The last part, referring to files and directories written
+        before: checksums, completions and rollups
+        """
+        file = FileInventory.File.__table__
+        directory = FileInventory.Directory.__table__
+        self.Execute(file.update().where(file.c.id == bindparam('file_id')).values(
+                md5sum=bindparam('digest')), batch.digests, 'checksum', session)
+        self.Execute(directory.update().where(directory.c.id == bindparam('dirid')).values(
+                complete=True), batch.done, 'completion of directory', session)
+        self.Execute(FileInventory.Rollup.__table__.insert(), batch.rollups, 'rollup', session)
+        logging.debug("Flushed {} directories, {} files, {} copies and {} checksums".format(
+                len(batch.directories), len(batch.files), len(batch.copies[True]) + len(batch.copies[False]),
+                len(batch.digests)))
+
+    def Compact(self, rows, session=None):
+        """
+        Convert rows for the file table to the compact layout, if that
+        is what the DB has, interning in session if given rather than ours
+        """
+        session = session or self.session
+        if rows and FileInventory.Layout.Compact(session.get_bind().dialect):
+            self.Interner(session).Encode(rows)
+        return rows
+
+    def Interner(self, session):
+        if self.interner is None:
+            self.interner = FileInventory.Interner(session)
+        return self.interner
+
+    @staticmethod
+    def CopyStatement(digests):
+        """
+        INSERT ... SELECT copying files from one directory to another
+        """
+        file = FileInventory.File.__table__
+        columns = [c.name for c in file.columns]
+        values = {'id': file.c.id + bindparam('offset'), 'parent': bindparam('new_parent')}
+        if not digests:
+            values['md5sum'] = null()
+        return file.insert().from_select(columns, select(
+                [values.get(c, file.c[c]) for c in columns]).where(file.c.parent == bindparam('prior')))
+
+    def Execute(self, statement, rows, what, session=None):
+        """
+        Execute statement for all of rows in one go, in session if
+        given rather than ours. If that fails for a reason which may
+        pass (see Transient), try again a few times, waiting longer
+        each time, and if it is still failing, raise the error: the
+        job can be carried on with later. If it fails for any other
+        reason, fall back to doing them one at a time, logging and
+        dropping any that fail.
+        """
+        if not rows:
+            return
+        session = session or self.session
+        for attempt in range(BatchWriter.Retries + 1):
+            try:
+                session.execute(statement, rows)
+                session.commit()
+                self.stats.Add('rows', len(rows))
+                return
+            except sqlalchemy.exc.DBAPIError as e:
+                session.rollback()
+                error = e
+                if not Transient(e):
+                    break
+                if attempt == BatchWriter.Retries:
+                    raise
+                wait = min(BatchWriter.Backoff * 2**attempt, BatchWriter.MaxBackoff)
+                self.stats.Add('db_retries')
+                logging.warning("Batch of {} {} rows failed ({}), retrying in {:.1f}s".format(
+                        len(rows), what, e.orig, wait))
+                time.sleep(wait)
+        self.stats.Add('db_retries')
+        logging.warning("Batch of {} {} rows failed ({}), retrying singly".format(len(rows), what, error.orig))
+        for row in rows:
+            try:
+                session.execute(statement, row)
+                session.commit()
+                self.stats.Add('rows')
+            except sqlalchemy.exc.DBAPIError as e:
+                self.stats.Add('db_errors')
+                logging.error("Error committing {} {}: {}".format(
+                        what, row.get('name', row.get('file_id', row.get('prior', row.get('dirid',
+                        row.get('directory_id'))))), e.orig))
+                session.rollback()
+
+    def Close(self):
+        """
+        Flush anything outstanding. The session is left open as it
+        belongs to the caller.
+        """
+        self.Flush()
+
+    def Stop(self):
+        """
+        Close, for good
+        """
+        self.Close()
+
+
+class AsyncWriter(BatchWriter):
+    """
+    A BatchWriter which, rather than writing each batch itself, hands
+    it to a pool of writer threads, each with a session (so a DB
+    connection) of its own. So whoever is adding rows, and the walk
+    behind them, carry on while the DB works. No more than Depth
+    batches per thread are left waiting: beyond that Flush blocks,
+    which holds the walk back to what the DB can take.
+
+    With more than one thread the parts of each batch (see Flush) are
+    written in turn where it matters: directories a batch at a time in
+    order, as later ones refer to them; then files, copies and changes
+    by any number of threads at once; and last checksums, completions
+    and rollups, in order again and only once the files of every batch
+    up to and including theirs are in, as they refer to those.
+
+    If a batch can't be written even after retrying (see Execute), no
+    more are, as a directory mustn't be marked complete without its
+    files, and the error is raised in the adding thread at its next
+    Flush or Close (see Check). The job can then be carried on with by
+    --resume.
+    """
+
+    Depth = 2
+
+    def __init__(self, session, batch_size=FileInventory.File.MaxCommitRecords, stats=None, writers=1):
+        super().__init__(session, batch_size, stats)
+        self.Session = sessionmaker(bind=session.get_bind())
+        self.batches = queue.Queue(maxsize=AsyncWriter.Depth * max(1, writers))
+        self.number = 0 # Of the next batch
+        self.turn = threading.Condition()
+        self.entered = 0 # Batches whose directories have been written
+        self.landed = set() # Batches whose files have been written, beyond
+        self.written = 0 # ... the first this many
+        self.finished = 0 # Batches written entirely
+        self.error = None
+        self.local = threading.local() # Each thread's Interner, as it uses the thread's session
+        self.stats.Gauge('db_backlog', self.batches.qsize)
+        self.threads = [threading.Thread(target=self.Worker, daemon=True) for _ in range(max(1, writers))]
+        for t in self.threads:
+            t.start()
+
+    def Flush(self):
+        """
+        Hand anything buffered to the writer threads, waiting if they
+        are too far behind
+        """
+        self.Check()
+        batch = self.Take()
+        if batch is None:
+            return
+        start = time.perf_counter()
+        self.batches.put((self.number, batch))
+        self.number += 1
+        self.stats.Time('db_wait', start)
+
+    def Check(self):
+        """
+        Raise the error a writer thread gave up on, if any: a
+        DBAPIError as it is, anything else as a WriterError
+        """
+        if isinstance(self.error, sqlalchemy.exc.DBAPIError):
+            raise self.error
+        if self.error is not None:
+            raise WriterError("{}: {}".format(type(self.error).__name__, self.error)) from self.error
+
+    def Worker(self):
+        session = self.Session()
+        try:
+            while True:
+                item = self.batches.get()
+                try:
+                    if item is None:
+                        break
+                    self.Write(*item, session)
+                finally:
+                    self.batches.task_done()
+        finally:
+            session.close()
+
+    def Write(self, number, batch, session):
+        """
+        Write a batch, numbered by Flush, waiting for its turn
+        """
+        start = time.perf_counter()
+        self.Turn(lambda: self.entered == number, self.WriteDirectories, batch, session)
+        with self.turn:
+            self.entered += 1
+            self.turn.notify_all()
+        self.Turn(lambda: True, self.WriteFiles, batch, session)
+        with self.turn:
+            self.landed.add(number)
+            while self.written in self.landed:
+                self.landed.remove(self.written)
+                self.written += 1
+            self.turn.notify_all()
+        self.Turn(lambda: self.written > number and self.finished == number, self.WriteUpdates, batch, session)
+        with self.turn:
+            self.finished += 1
+            self.turn.notify_all()
+        self.stats.Time('flush', start)
+
+    def Turn(self, Ready, Write, batch, session):
+        """
+        Wait until Ready() is true, then do Write, unless a batch has
+        failed by then
+        """
+        with self.turn:
+            self.turn.wait_for(Ready)
+            if self.error is not None:
+                return
+        try:
+            Write(batch, session)
+        except Exception as e:
+            logging.error("Giving up writing to the DB: {}".format(e))
+            with self.turn:
+                if self.error is None:
+                    self.error = e
+
+    def Interner(self, session):
+        try:
+            return self.local.interner
+        except AttributeError: # Others may be interning the same values, which Interner allows for
+            self.local.interner = FileInventory.Interner(session)
+            return self.local.interner
+
+    def Close(self):
+        """
+        Flush anything outstanding, and wait until it has all been
+        written
+        """
+        self.Flush()
+        self.batches.join()
+        self.Check()
+
+    def Stop(self):
+        """
+        Close, and finish off the writer threads
+        """
+        try:
+            self.Close()
+        finally:
+            for _ in self.threads:
+                self.batches.put(None)
+            for t in self.threads:
+                t.join()
+
+
+class ColumnarWriter:
+    """
+    Has the same Add methods as BatchWriter, but rather than the DB,
+    writes each table to its own file in directory, a batch at a
+    time, either as a row group of a Parquet file or a chunk of a
+    gzipped CSV file. Only a batch of each table is ever in memory.
+
+    Nothing can be updated once written, so checksums computed after
+    the event go in a table of their own, digest, keyed by file ID,
+    and there is no resuming or incremental scanning from the files.
+    """
+
+    Incremental = False
+    Formats = ('parquet', 'csv')
+    Suffixes = {'parquet': '.parquet', 'csv': '.csv.gz'}
+    Digest = [('file_id', int), ('digest', str)]
+
+    def __init__(self, directory, batch_size=FileInventory.File.MaxCommitRecords, format='parquet', stats=None):
+        if format == 'parquet' and pyarrow is None:
+            raise ValueError("Writing Parquet needs pyarrow, which isn't installed")
+        os.makedirs(directory, exist_ok=True)
+        self.session = None # No DB
+        self.directory = directory
+        self.batch_size = max(1, int(batch_size))
+        self.stats = stats or InventoryStats.Stats()
+        self.format = format
+        self.columns = {'job': self.Columns(FileInventory.Job),
+                        'directory': self.Columns(FileInventory.Directory),
+                        'file': self.Columns(FileInventory.File),
+                        'rollup': self.Columns(FileInventory.Rollup),
+                        'digest': ColumnarWriter.Digest}
+        self.rows = {table: [] for table in self.columns}
+        self.writers = {} # Table: (file, writer) once there is something to write
+
+    @staticmethod
+    def Columns(cls):
+        """
+        (name, Python type) for the columns of a table
+        """
+        return [(c.name, c.type.python_type) for c in cls.__table__.columns]
+
+    def Path(self, table):
+        """
+        The file a table is written to
+        """
+        return os.path.join(self.directory, table + ColumnarWriter.Suffixes[self.format])
+
+    def Add(self, table, row):
+        """
+        Queue a row for a table, writing the batch if it's full
+        """
+        rows = self.rows[table]
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self.Write(table)
+
+    def AddJob(self, **row):
+        self.Add('job', row)
+
+    def AddDirectory(self, **row):
+        self.Add('directory', row)
+
+    def AddFile(self, record):
+        self.Add('file', record)
+
+    def AddRollup(self, **row):
+        self.Add('rollup', row)
+
+    def AddDigest(self, file_id, digest):
+        self.Add('digest', {'file_id': file_id, 'digest': digest})
+
+    def AddDone(self, dirid):
+        pass # Only needed for resuming, which we can't
+
+    def Write(self, table):
+        """
+        Write out the rows queued for a table
+        """
+        rows, self.rows[table] = self.rows[table], []
+        if not rows:
+            return
+        start = time.perf_counter()
+        if table == 'file':
+            rows = FileRows(rows)
+        columns = self.columns[table]
+        if self.format == 'parquet':
+            types = {int: pyarrow.int64(), bool: pyarrow.bool_(), str: pyarrow.string(),
+                     datetime.datetime: pyarrow.timestamp('us')}
+            schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+            if table not in self.writers:
+                self.writers[table] = (None, pyarrow.parquet.ParquetWriter(self.Path(table), schema,
+                                                                             compression='zstd'))
+            self.writers[table][1].write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+        else:
+            if table not in self.writers:
+                f = gzip.open(self.Path(table), 'wt', newline='')
+                writer = csv.DictWriter(f, [name for name, _ in columns], extrasaction='ignore')
+                writer.writeheader()
+                self.writers[table] = (f, writer)
+            self.writers[table][1].writerows(rows)
+        self.stats.Time('flush', start)
+        self.stats.Add('rows', len(rows))
+        logging.debug("Wrote {} {} rows".format(len(rows), table))
+
+    def Flush(self):
+        """
+        Write whatever is queued. Directories first, as for BatchWriter,
+        so the files written so far always have theirs.
+        """
+        for table in self.rows:
+            self.Write(table)
+
+    def Close(self):
+        """
+        Flush anything outstanding. As with BatchWriter, more can be
+        added after.
+        """
+        self.Flush()
+
+    def Stop(self):
+        """
+        Close, and close the files, which can't be added to after
+        """
+        self.Close()
+        for f, writer in self.writers.values():
+            if f is None:
+                writer.close()
+            else:
+                f.close()
+        self.writers = {}
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Brings an inventory DB made by an earlier version up to date, and
+converts its file table between the wide and compact layouts (see
+FileInventory.Layout).
+
+Columns which are missing are added to the tables there are, missing
+tables and indexes are created, and indexes on the file table which
+are no longer wanted are dropped. Columns narrower than they now are
+are widened: IDs which were INTEGER, as the scanner's go past 2**32
+(see Directory.MakeID), and checksums which only had room for MD5.
+Jobs which were checksummed before the algorithm was recorded get
+theirs, which could only be MD5. Changing the layout means copying
+the whole file table, a batch at a time, in to a new one which then
+takes its place. That needs room for both at once, and as other tables
+refer to the file table, should be done while nothing else is using
+the DB. If it is interrupted the old table is still there, untouched.
+"""
+
+import argparse
+import getpass
+import logging
+
+from sqlalchemy import create_engine, inspect, select, text, MetaData, Table, TypeDecorator
+from sqlalchemy import BigInteger, Integer, String
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+import sqlalchemy.exc
+
+import FileInventory
+
+
+def AddColumns(cnx):
+    """
+    Add the columns the model has which the tables in the DB don't.
+    They are left NULL, as they would be for a row written before.
+    """
+    inspector = inspect(cnx)
+    for table in FileInventory.Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        there = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in there:
+                logging.info("Adding column {}.{}".format(table.name, column.name))
+                cnx.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name, column.type.compile(cnx.dialect))))
+
+
+def Narrower(there, wanted):
+    """
+    Whether a column type as reflected from the DB can't hold all the
+    values of the type the model wants (which for a TypeDecorator is
+    the type it uses for the DB)
+    """
+    if isinstance(wanted, BigInteger):
+        return isinstance(there, Integer) and not isinstance(there, BigInteger)
+    binary = FileInventory.Layout.BinaryTypes
+    if (isinstance(wanted, String) and isinstance(there, String)) or (
+            isinstance(wanted, binary) and isinstance(there, binary)):
+        return there.length is not None and wanted.length is not None and there.length < wanted.length
+    return False
+
+
+def Widen(cnx, skip=()):
+    """
+    Alter the columns the DB has narrower than the model, except in
+    the tables in skip. SQLite keeps any size of integer or string
+    whatever the column says, so is left alone.
+    """
+    if cnx.dialect.name == 'sqlite':
+        return
+    inspector = inspect(cnx)
+    ForeignKeys(cnx, False) # MySQL won't otherwise change either end of a foreign key
+    try:
+        for table in FileInventory.Base.metadata.sorted_tables:
+            if table.name in skip or not inspector.has_table(table.name):
+                continue
+            there = {c['name']: c for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                wanted = column.type
+                if isinstance(wanted, TypeDecorator):
+                    wanted = wanted.load_dialect_impl(cnx.dialect)
+                if column.name not in there or not Narrower(there[column.name]['type'], wanted):
+                    continue
+                logging.info("Widening column {}.{} to {}".format(table.name, column.name,
+                             wanted.compile(cnx.dialect)))
+                if cnx.dialect.name == 'mysql': # Which wants the whole column, NOT NULL and all
+                    cnx.execute(text('ALTER TABLE {} MODIFY {} {}{}'.format(table.name, column.name,
+                            wanted.compile(cnx.dialect), '' if there[column.name]['nullable'] else ' NOT NULL')))
+                else:
+                    cnx.execute(text('ALTER TABLE {} ALTER COLUMN {} TYPE {}'.format(
+                            table.name, column.name, wanted.compile(cnx.dialect))))
+    finally:
+        ForeignKeys(cnx, True)
+
+
+def Digests(cnx):
+    """
+    Jobs from before the checksum algorithm was recorded only had a
+    flag for whether they did MD5 sums
+    """
+    if 'md5sum' in {c['name'] for c in inspect(cnx).get_columns('job')}:
+        number = cnx.execute(text('UPDATE job SET digest = :md5 WHERE md5sum AND digest IS NULL'),
+                             {'md5': 'md5'}).rowcount
+        if number:
+            logging.info("Recorded {} jobs as checksummed with MD5".format(number))
+
+
+def Indexes(cnx):
+    """
+    Create the indexes the model has which the DB doesn't, and drop
+    those on the file table which it no longer has. MySQL makes an
+    index of its own for each foreign key, which is kept unless one
+    of ours begins with the same column.
+    """
+    inspector = inspect(cnx)
+    for table in FileInventory.Base.metadata.sorted_tables:
+        there = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in there:
+                logging.info("Creating index {}".format(index.name))
+                index.create(cnx)
+    file = FileInventory.File.__table__
+    wanted = {index.name for index in file.indexes}
+    leading = {list(index.columns)[0].name for index in file.indexes}
+    keys = {key.parent.name for key in file.foreign_keys}
+    for index in Table(file.name, MetaData(), autoload_with=cnx).indexes:
+        first = list(index.columns)[0].name
+        if index.name in wanted or index.unique or (first in keys and first not in leading):
+            continue
+        logging.info("Dropping index {}".format(index.name))
+        try:
+            index.drop(cnx)
+        except sqlalchemy.exc.DBAPIError as e:
+            logging.warning("Can't drop index {} ({})".format(index.name, e.orig))
+
+
+def ForeignKeys(cnx, on):
+    """
+    Turn checking of foreign keys on or off for this connection, so
+    the file table can be dropped while others still refer to it
+    """
+    if cnx.dialect.name == 'sqlite':
+        cnx.execute(text('PRAGMA foreign_keys={}'.format('ON' if on else 'OFF')))
+    elif cnx.dialect.name == 'mysql':
+        cnx.execute(text('SET FOREIGN_KEY_CHECKS={}'.format(1 if on else 0)))
+
+
+def Convert(cnx, batch_size):
+    """
+    Copy the file table in to one with the layout the connection's
+    engine has been set to use (which must not be the one it has),
+    then put that in its place
+    """
+    file = FileInventory.File.__table__
+    reflected = MetaData()
+    old = Table(file.name, reflected, autoload_with=cnx) # So read as it is, whatever the layout
+    for other in ('directory', 'attributes', 'extension'): # For the foreign keys of the new table
+        Table(other, reflected, autoload_with=cnx)
+    new = file.to_metadata(reflected, name=file.name + '_new')
+    session = Session(bind=cnx)
+    interner = FileInventory.Interner(session)
+    compact = FileInventory.Layout.Compact(cnx.dialect)
+    typed = [c.name for c in file.columns if isinstance(c.type, TypeDecorator)]
+    ForeignKeys(cnx, False)
+    try:
+        if inspect(cnx).has_table(new.name): # Left by an interrupted attempt
+            new.drop(cnx)
+        cnx.execute(CreateTable(new)) # Without the indexes, which come after
+        last, number = None, 0
+        while True:
+            query = select([old]).order_by(old.c.id).limit(batch_size)
+            if last is not None:
+                query = query.where(old.c.id > last)
+            rows = [dict(row) for row in session.execute(query)]
+            if not rows:
+                break
+            last = rows[-1]['id']
+            for row in rows:
+                for name in typed: # From how the DB has them to how Python does
+                    row[name] = file.c[name].type.process_result_value(row[name], cnx.dialect)
+            if compact:
+                interner.Encode(rows)
+            else:
+                interner.Decode(rows)
+            session.execute(new.insert(), rows)
+            session.commit()
+            number += len(rows)
+            logging.info("Copied {:,} files".format(number))
+        old.drop(cnx)
+        cnx.execute(text('ALTER TABLE {} RENAME TO {}'.format(new.name, file.name)))
+    finally:
+        ForeignKeys(cnx, True)
+    session.close()
+
+
+def GetArgs():
+    """
+    Process command line arguments
+    """
+    ap = argparse.ArgumentParser(description='Bring an inventory DB up to date, or change its layout')
+    gr = ap.add_mutually_exclusive_group()
+    ly = ap.add_mutually_exclusive_group()
+    ex = ap.add_argument_group(title='Exotic', description='Here be dragons')
+    ap.add_argument('--host',         '-t', help='DB hostname or IP address', default='merlin')
+    ap.add_argument('--user',         '-u', help='DB username', default='tim')
+    gr.add_argument('--password',     '-p', help='DB password')
+    gr.add_argument('--blank',        '-b', help='Permit blank password', action='store_true')
+    ap.add_argument('--schema',       '-s', help='DB schema', default='inventory')
+    ap.add_argument('--connector',    '-c', help='DB connector', default='mysql+mysqlconnector')
+    ap.add_argument('--local',        '-l', help='Use this SQLite file rather than the DB server', metavar='FILE')
+    ly.add_argument('--compact',      '-C', help='Convert the file table to the compact layout',
+                    action='store_true')
+    ly.add_argument('--wide',         '-W', help='Convert the file table to the wide layout',
+                    action='store_true')
+    ex.add_argument('--commit-rec',   '-r', help='Max records after which to commit', type=int,
+                    default=FileInventory.File.MaxCommitRecords)
+    ex.add_argument('--sql-debug',    '-q', help='Print details of SQL commands', action='store_true')
+    ex.add_argument('--verbose',      '-v', help='Verbosity', action='count')
+    return ap.parse_args()
+
+
+if __name__ == '__main__':
+    args = GetArgs()
+    while not (args.blank or args.password or args.local): # Prompt for a password if required
+        args.password = getpass.getpass()
+
+    if not args.verbose: # Is None if not specified
+        args.verbose = 0
+
+    loglevels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    level = loglevels[min(args.verbose, len(loglevels)- 1)]
+    logging.basicConfig(level = level, format = '%(asctime)s %(message)s')
+
+    if args.password:
+        connectstr = '{}://{}:{}@{}/{}'.format(args.connector, args.user,
+                      args.password, args.host, args.schema)
+    else:
+        connectstr = '{}://{}@{}/{}'.format(args.connector, args.user,
+                      args.host, args.schema)
+
+    try:
+        if args.local:
+            engine = FileInventory.LocalEngine(args.local, echo = True if args.sql_debug else False)
+        else:
+            engine = create_engine(connectstr, pool_recycle=3600,
+                                   echo = True if args.sql_debug else False)
+    except sqlalchemy.exc.NoSuchModuleError as e:
+        logging.critical("Error creating engine: {}".format(e))
+    else:
+        compact = FileInventory.Layout.Setup(engine)
+        wanted = args.compact or (compact and not args.wide)
+        FileInventory.Layout.Use(engine, wanted) # Before anything uses the file table's types
+        with engine.connect() as cnx:
+            AddColumns(cnx)
+            FileInventory.Base.metadata.create_all(cnx, checkfirst = True)
+            # A file table about to be converted is made anew, as wide as it should be
+            Widen(cnx, [FileInventory.File.__tablename__] if wanted != compact else [])
+            Digests(cnx)
+            if wanted != compact:
+                logging.info("Converting the file table to the {} layout".format('compact' if wanted else 'wide'))
+                Convert(cnx, args.commit_rec)
+            Indexes(cnx)
+        logging.info("The DB is up to date, with the {} layout".format('compact' if wanted else 'wide'))
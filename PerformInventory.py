@@ -17,19 +17,25 @@ Tim Greening-Jackson 30 August 2017
 import sys
 import os
 import os.path
+import time
 import argparse
 import socket
 import getpass
 import datetime
 import logging
-import mysql.connector
-import mysql.connector.errors
+import itertools
+import collections
+import queue
+import threading
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, select
 from sqlalchemy.orm import sessionmaker
 import sqlalchemy.exc
 
 import FileInventory
+import InventoryWriter
+import InventoryStats
+import HashInventory
 
 
 def GetArgs():
@@ -46,8 +52,41 @@ def GetArgs():
     ap.add_argument('--schema',      '-s', help='DB schema', default='inventory')
     ap.add_argument('--description', '-d', help='Job description (may need quotes)')
     ap.add_argument('--connector',   '-c', help='DB connector', default='mysql+mysqlconnector')
+    ap.add_argument('--local',       '-l', help='Use this SQLite file rather than the DB server', metavar='FILE')
+    ap.add_argument('--output',      '-o', help='Write the inventory to files in this directory instead of a DB',
+                    metavar='DIR')
+    ap.add_argument('--format',      '-f', help='Format of files written with --output', default='parquet',
+                    choices=InventoryWriter.ColumnarWriter.Formats)
     ap.add_argument('--nuke',        '-n', help='Drop DB tables and restart', action='store_true')
-    ap.add_argument('--md5sum',      '-m', help='Compute MD5 sum for each file', action='store_true')
+    ap.add_argument('--compact',     '-C', help='Create a new DB with the compact layout (for an existing one '
+                    'see MigrateInventory.py)', action='store_true')
+    ap.add_argument('--md5sum',      '-m', help='Compute MD5 sum for each file (same as --digest md5)',
+                    dest='digest', action='store_const', const='md5')
+    ap.add_argument('--digest',      '-a', help='Compute a checksum for each file using this algorithm',
+                    choices=sorted(FileInventory.Digests))
+    ap.add_argument('--incremental', '-i', help='Only rescan what has changed since this job', type=int,
+                    metavar='JOB_ID')
+    ap.add_argument('--resume',      '-R', help='Carry on with an interrupted job', type=int,
+                    metavar='JOB_ID')
+    ap.add_argument('--metrics',     '-M', help='Append progress reports to this file as lines of JSON',
+                    metavar='FILE')
+    ap.add_argument('--max-rate',    '-x', help='Read no more than this many MB/s computing checksums',
+                    type=float)
+    ap.add_argument('--max-iops',    '-y', help='Make no more than this many reads/s computing checksums',
+                    type=float)
+    ex.add_argument('--max-latency', '-Y', help='Slow checksumming down if reads take longer than this many ms '
+                    '(default: when they take {} times as long as at best)'.format(
+                    HashInventory.Throttle.Backoff), type=float)
+    ex.add_argument('--progress',    '-P', help='Seconds between progress reports (0 for none)', type=float,
+                    default=60)
+    ex.add_argument('--workers',     '-w', help='Number of threads scanning directories', type=int, default=1)
+    ex.add_argument('--hash-workers','-H', help='Number of processes computing checksums', type=int)
+    ex.add_argument('--db-writers',  '-W', help='Number of threads writing to the DB (0 to write from the '
+                    'thread taking rows from the scan)', type=int, default=1)
+    ex.add_argument('--chunk-size',  '-g', help='Chunk size for computing checksums', type=int,
+                    default=FileInventory.File.DefaultMD5Chunk)
+    ex.add_argument('--commit-rec',  '-r', help='Max records after which to commit', type=int,
+                    default=FileInventory.File.MaxCommitRecords)
     ex.add_argument('--sql-debug',   '-q', help='Print details of SQL commands', action='store_true')
     ex.add_argument('--verbose',     '-v', help='Verbosity', action='count')
 
@@ -56,94 +95,941 @@ def GetArgs():
 
 
 
-def ProcessDirectory(session, directory, job_id, compute_md5, parent=None):
+def ExpectedFiles(session, path):
     """
-    Scans the files in a directory, and sticks them in the 
-    database. Note that as a directory potentially contains
-    several million records, we commit on a regular basis to
-    avoid memory exhaustion.
-    
-    Parameter root is a flag indicating whether this directory is the
-    root of the tree we are searching, so is True for the first call,
-    but False for any recursions.
+    How many files there were in path the last time it was scanned,
+    if it ever was, for guessing how long this time will take. The
+    rollup of the top directory has them all, however they got there.
     """
-    try:
-        if os.path.isdir(directory):
-            logging.info("Processing directory {}".format(directory))
-    
-            try:
-                st = os.stat(directory)
-            except FileNotFoundError:
-                logging.warning("No such file or directory {}".format(directory))
+    job = FileInventory.Job
+    return session.query(FileInventory.Rollup.files).join(
+            FileInventory.Directory, FileInventory.Directory.id == FileInventory.Rollup.directory_id).join(
+            job, job.id == FileInventory.Rollup.job_id).filter(
+            job.path == path, job.ended.isnot(None),
+            FileInventory.Directory.parent.is_(None)).order_by(job.id.desc()).limit(1).scalar()
+
+
+def JobTotals(session, job, totals, resumed=False):
+    """
+    What to keep in the job table (see InventoryStats.Stats.Summary)
+    from the totals of this run. Those leave out the files copied by
+    an incremental scan, and any written before a resume, so once the
+    whole tree has been added up, the rollup of its top directory has
+    the files, bytes and directories instead. On resuming, what was
+    hashed and the errors are added to those of the earlier runs.
+    """
+    summary = InventoryStats.Stats.Summary(totals)
+    if resumed:
+        for name in ('hashed', 'hashed_bytes', 'errors'):
+            summary[name] += getattr(job, name) or 0
+    rollup = session.query(FileInventory.Rollup).join(
+            FileInventory.Directory, FileInventory.Directory.id == FileInventory.Rollup.directory_id).filter(
+            FileInventory.Rollup.job_id == job.id, FileInventory.Directory.parent.is_(None)).one_or_none()
+    if rollup is not None:
+        summary.update(files=rollup.files, bytes=rollup.bytes, directories=rollup.directories + 1)
+    return summary
+
+
+class PreviousJob:
+    """
+    What an earlier job found, for an incremental scan. All its
+    directories are held in memory, as there are vastly fewer of them
+    than files. Its files are only looked up a directory at a time,
+    and only for directories which have changed, and in a directory
+    with more than PageFiles of them, a part at a time (see Files).
+
+    Names are as cleaned for the DB, so more than one file or
+    directory in a directory can have the same one, and those can't
+    be told apart.
+    """
+
+    PageFiles = 100000 # Files of a changed directory held at once
+
+    def __init__(self, session, job_id):
+        job = session.query(FileInventory.Job).get(job_id)
+        if job is None:
+            raise ValueError("No such job {}".format(job_id))
+        self.id = job.id
+        self.path = job.path
+        self.digest = job.digest
+        self.engine = session.get_bind()
+        self.root = None
+        self.children = collections.defaultdict(dict) # Directory ID: {name: [ID, ...]}
+        self.stats = {} # Directory ID: (mtime, size, ctime)
+        d = FileInventory.Directory
+        for dirid, parent, name, mtime, size, ctime in session.query(
+                d.id, d.parent, d.name, d.mtime, d.size, d.ctime).filter(d.job_id == job_id):
+            self.stats[dirid] = (mtime, size, ctime)
+            if parent is None:
+                self.root = dirid
             else:
-                if parent: # If there is no parent then there is no relative directory name
-                   
-                    d = FileInventory.Directory(name = os.path.split(directory)[1], 
-                            job_id = job_id, parent = parent, 
-                            serial = next(FileInventory.Directory.Bates),
-                            atime = datetime.datetime.fromtimestamp(st.st_atime), 
-                            mtime = datetime.datetime.fromtimestamp(st.st_mtime), 
-                            ctime = datetime.datetime.fromtimestamp(st.st_ctime), 
-                            mode = st.st_mode, uid = st.st_uid, gid = st.st_gid,
-                            size = st.st_size)
-                else:
-                    d = FileInventory.Directory(
-                            job_id = job_id, parent = parent, 
-                            serial = next(FileInventory.Directory.Bates),
-                            atime = datetime.datetime.fromtimestamp(st.st_atime), 
-                            mtime = datetime.datetime.fromtimestamp(st.st_mtime), 
-                            ctime = datetime.datetime.fromtimestamp(st.st_ctime), 
-                            mode = st.st_mode, uid = st.st_uid, gid = st.st_gid,
-                            size = st.st_size)
-                
-                session.add(d)
-                session.commit() # Do a commit here as sometimes the DB gets behind itself and we get a FK integrity error
+                self.children[parent].setdefault(name, []).append(dirid)
+        if self.root is None or self.root // d.IDBlock != job_id:
+            raise ValueError("Job {} can't be used for an incremental scan as its IDs "
+                             "weren't allocated by the scanner".format(job_id))
+        base = FileInventory.File.MakeID(job_id, 0)
+        (last,) = session.query(func.max(FileInventory.File.id)).filter(
+                FileInventory.File.id.between(base, base + FileInventory.File.IDBlock - 1)).one()
+        self.next_serial = (last or base) - base + 1 # Copied files keep their serial numbers
+
+    @staticmethod
+    def Same(when, timestamp):
+        """
+        Compare a time from the DB with one from stat. Some DBs don't
+        keep fractions of a second, and some round rather than truncate.
+        """
+        return when is not None and abs(when - datetime.datetime.fromtimestamp(timestamp)) < datetime.timedelta(seconds=1)
+
+    def Unchanged(self, prior, st, lossy=False):
+        """
+        Whether nothing has been added to, removed from or renamed in a
+        directory, judging by its mtime and size. If its name was
+        changed by cleaning (lossy), it might have been paired with
+        a sibling's, so its ctime has to be the same too.
+        """
+        mtime, size, ctime = self.stats[prior]
+        return (size == st.st_size and PreviousJob.Same(mtime, st.st_mtime) and
+                (not lossy or PreviousJob.Same(ctime, st.st_ctime)))
+
+    def Parts(self, prior):
+        """
+        How many parts to take a directory's files in, so no more than
+        about PageFiles of them are held at once
+        """
+        file = FileInventory.File.__table__
+        with self.engine.connect() as cnx:
+            number = cnx.execute(select([func.count(file.c.id)]).where(file.c.parent == prior)).scalar()
+        return max(1, (number + PreviousJob.PageFiles - 1) // PreviousJob.PageFiles)
+
+    @staticmethod
+    def InPart(name, part, parts):
+        """
+        Whether a file, by its name as cleaned, is in part of parts
+        """
+        return parts == 1 or hash(name) % parts == part
+
+    def Files(self, prior, part=0, parts=1):
+        """
+        Returns {name: [row, ...]} for the files in a directory, with
+        more than one row where names were the same once cleaned. If
+        there are too many to hold at once (see Parts), only those in
+        part of parts are returned, and the directory is gone through
+        once for each part. Called from the walker threads, so uses a
+        connection of its own.
+        """
+        file = FileInventory.File.__table__
+        files = {}
+        with self.engine.connect() as cnx:
+            for row in cnx.execution_options(stream_results=True).execute(select([file.c.id, file.c.name,
+                    file.c.size, file.c.mtime, file.c.md5sum]).where(file.c.parent == prior)):
+                if PreviousJob.InPart(row.name, part, parts):
+                    files.setdefault(row.name, []).append(row)
+        return files
+
+    def Own(self, prior):
+        """
+        Totals of the files directly in a directory, which are what gets
+        copied if it hasn't changed. Taken from the previous job's
+        rollup if it has one, otherwise added up from its files.
+        """
+        rollup = FileInventory.Rollup.__table__
+        file = FileInventory.File.__table__
+        with self.engine.connect() as cnx:
+            row = cnx.execute(select([rollup.c.own_files, rollup.c.own_bytes, rollup.c.own_first_ctime,
+                    rollup.c.own_last_ctime, rollup.c.own_first_mtime, rollup.c.own_last_mtime]).where(
+                    rollup.c.directory_id == prior)).first()
+            if row is None:
+                row = cnx.execute(select(Totals.Aggregates(file)).where(file.c.parent == prior)).first()
+        return Totals.FromRow(row)
+
+
+class ResumedJob:
+    """
+    How far an interrupted job got: which of its directories are
+    already in the DB, and which of those are complete. Together
+    these are the checkpoint we carry on from. Serial numbers carry
+    on from where they left off.
+
+    Directories are known by their parent and their name as cleaned
+    for the DB, which two siblings can share, so each row can only be
+    claimed once, and only by a directory which looks like it did.
+    Rows which are never claimed are dropped once the walk is done.
+    """
+
+    MaxDrop = 500 # Directories dropped per statement
+
+    def __init__(self, session, job_id):
+        job = session.query(FileInventory.Job).get(job_id)
+        if job is None:
+            raise ValueError("No such job {}".format(job_id))
+        if job.ended:
+            raise ValueError("Job {} finished at {}".format(job_id, job.ended))
+        self.job = job
+        d = FileInventory.Directory
+        self.directories = collections.defaultdict(list) # (parent, name): [(ID, complete, mtime, ctime)]
+        for dirid, parent, name, complete, mtime, ctime in session.query(
+                d.id, d.parent, d.name, d.complete, d.mtime, d.ctime).filter(d.job_id == job_id):
+            self.directories[(parent, name)].append((dirid, complete, mtime, ctime))
+        self.known = set(self.directories)
+        self.lock = threading.Lock() # Claimed from the walker threads
+        for cls in (FileInventory.Directory, FileInventory.File):
+            base = cls.MakeID(job_id, 0)
+            (last,) = session.query(func.max(cls.id)).filter(cls.id.between(base, base + cls.IDBlock - 1)).one()
+            cls.Bates = itertools.count((last or base) - base + 1)
+        # Files of complete directories aren't read again, but still count towards the rollup
+        file = FileInventory.File
+        base = file.MakeID(job_id, 0)
+        self.own = {row[0]: Totals.FromRow(row[1:]) for row in session.query(file.parent, *Totals.Aggregates(
+                file.__table__)).filter(file.id.between(base, base + file.IDBlock - 1)).group_by(file.parent)}
+        # Only finished subtrees have a rollup, and which those are will have changed
+        session.query(FileInventory.Rollup).filter(FileInventory.Rollup.job_id == job_id).delete()
+        session.commit()
+        logging.info("Resuming job {} with {} directories done".format(
+                job_id, sum(row[1] for rows in self.directories.values() for row in rows)))
+
+    def Lookup(self, parent, name, raw, st):
+        """
+        Returns (ID, complete) for a directory already in the DB, or None.
+        Parameter name is as cleaned for the DB, raw as it is on disk,
+        and st is what stat says about it now. If cleaning changed the
+        name, so a sibling might have had the same one, the row has to
+        have the same times too, and be the only one which does.
+        """
+        with self.lock:
+            rows = self.directories.get((parent, name))
+            if not rows:
+                return None
+            candidates = rows
+            if raw is not None and FileInventory.Directory.NameRe.search(raw):
+                candidates = [row for row in rows if PreviousJob.Same(row[2], st.st_mtime) and
+                              PreviousJob.Same(row[3], st.st_ctime)]
+            if len(candidates) != 1:
+                return None
+            row = candidates[0]
+            rows.remove(row)
+            return row[:2]
+
+    def Known(self, parent, name):
+        """
+        Whether there was a row for a directory of this name, even if
+        it couldn't be claimed
+        """
+        return (parent, name) in self.known
+
+    def Drop(self, session):
+        """
+        Delete the directories which weren't claimed, with their files
+        and changes: they have gone since, or couldn't be told apart
+        from a sibling so have been scanned again as new ones. Highest
+        IDs first, so subdirectories go before their parents.
+        """
+        stale = sorted((row[0] for rows in self.directories.values() for row in rows), reverse=True)
+        if not stale:
+            return
+        logging.info("Dropping {} directories which weren't found again".format(len(stale)))
+        directory = FileInventory.Directory.__table__
+        file = FileInventory.File.__table__
+        change = FileInventory.Change.__table__
+        for i in range(0, len(stale), ResumedJob.MaxDrop):
+            ids = stale[i:i + ResumedJob.MaxDrop]
+            files = select([file.c.id]).where(file.c.parent.in_(ids))
+            session.execute(change.delete().where(change.c.job_id == self.job.id).where(
+                    change.c.directory_id.in_(ids) | change.c.file_id.in_(files)))
+            session.execute(file.delete().where(file.c.parent.in_(ids)))
+            session.execute(directory.delete().where(directory.c.id.in_(ids)))
+            session.commit()
+        self.directories.clear()
+
+    def Own(self, dirid):
+        """
+        Totals of the files already written for a directory
+        """
+        return self.own.get(dirid, Totals())
+
+
+class Totals:
+    """
+    Number and size of some files, and the range of their ctimes and
+    mtimes. The columns of a FileInventory.Rollup. Times are kept as
+    they come from stat, and only made datetimes for the DB.
+    """
+
+    __slots__ = ('files', 'bytes', 'directories', 'first_ctime', 'last_ctime', 'first_mtime', 'last_mtime')
+
+    def __init__(self, files=0, bytes=0, directories=0, first_ctime=None, last_ctime=None,
+                 first_mtime=None, last_mtime=None):
+        self.files = int(files or 0) # Some DBs return sums as Decimal
+        self.bytes = int(bytes or 0)
+        self.directories = directories
+        self.first_ctime = first_ctime
+        self.last_ctime = last_ctime
+        self.first_mtime = first_mtime
+        self.last_mtime = last_mtime
+
+    @staticmethod
+    def Aggregates(file):
+        """
+        Columns to select from the file table to make a Totals (see FromRow)
+        """
+        return [func.count(file.c.id), func.sum(file.c.size), func.min(file.c.ctime),
+                func.max(file.c.ctime), func.min(file.c.mtime), func.max(file.c.mtime)]
+
+    @staticmethod
+    def FromRow(row):
+        """
+        Totals of files from the DB: their number, size, and first and
+        last ctime and mtime, as in Aggregates or the own_ columns of
+        the rollup table
+        """
+        files, bytes, *times = row
+        return Totals(files, bytes, 0, *(t.timestamp() if t is not None else None for t in times))
+
+    def Add(self, size, ctime, mtime):
+        """
+        Count a file
+        """
+        self.files += 1
+        self.bytes += size
+        if self.files == 1:
+            self.first_ctime = self.last_ctime = ctime
+            self.first_mtime = self.last_mtime = mtime
+        else:
+            self.first_ctime = min(self.first_ctime, ctime)
+            self.last_ctime = max(self.last_ctime, ctime)
+            self.first_mtime = min(self.first_mtime, mtime)
+            self.last_mtime = max(self.last_mtime, mtime)
+
+    def Merge(self, other):
+        """
+        Add in other's files
+        """
+        self.files += other.files
+        self.bytes += other.bytes
+        self.directories += other.directories
+        for first, last in (('first_ctime', 'last_ctime'), ('first_mtime', 'last_mtime')):
+            times = [t for t in (getattr(self, first), getattr(other, first)) if t is not None]
+            setattr(self, first, min(times, default=None))
+            times = [t for t in (getattr(self, last), getattr(other, last)) if t is not None]
+            setattr(self, last, max(times, default=None))
+
+    def Row(self, prefix=''):
+        """
+        Columns for the rollup table
+        """
+        row = {prefix + 'files': self.files, prefix + 'bytes': self.bytes}
+        if not prefix:
+            row['directories'] = self.directories
+        for k in ('first_ctime', 'last_ctime', 'first_mtime', 'last_mtime'):
+            t = getattr(self, k)
+            row[prefix + k] = datetime.datetime.fromtimestamp(t) if t is not None else None
+        return row
+
+
+class Rollups:
+    """
+    Adds up the totals for each directory's subtree as the walk
+    finishes it. A directory is finished once it has been listed and
+    so has every subdirectory found in it, which with several workers
+    can happen in any order, so for each directory in progress we
+    count how many of those are still outstanding. A subtree with a
+    directory which couldn't be listed to the end gets no rollup, nor
+    does anything above it, as their totals would be short.
+    """
+
+    def __init__(self, job_id, results):
+        self.job_id = job_id
+        self.results = results
+        self.nodes = {} # Directory ID: [parent, outstanding, own Totals, subtree Totals]
+        self.partial = set() # Directories with something missing from their subtrees
+        self.lock = threading.Lock()
+
+    def Start(self, dirid, parent):
+        """
+        A directory has been entered, so is outstanding until listed
+        """
+        with self.lock:
+            self.nodes[dirid] = [parent, 1, None, Totals()]
+
+    def Expect(self, dirid):
+        """
+        A subdirectory has been found in a directory
+        """
+        with self.lock:
+            self.nodes[dirid][1] += 1
+
+    def Done(self, dirid, own):
+        """
+        A directory has been listed, and own are the totals of its files
+        """
+        with self.lock:
+            node = self.nodes[dirid]
+            node[2] = own
+            node[3].Merge(own)
+        self.Release(dirid)
+
+    def Abandon(self, dirid):
+        """
+        A directory couldn't be listed to the end, so neither it nor
+        anything above it can be added up (see ResumedJob)
+        """
+        with self.lock:
+            self.partial.add(dirid)
+        self.Release(dirid)
+
+    def Release(self, dirid):
+        """
+        One fewer thing outstanding in a directory. If that was the last,
+        its subtree is finished, so its totals are added to its parent's,
+        which may finish that in turn.
+        """
+        while dirid is not None:
+            with self.lock:
+                node = self.nodes[dirid]
+                node[1] -= 1
+                if node[1]:
+                    return
+                parent, _, own, subtree = self.nodes.pop(dirid)
+                partial = dirid in self.partial
+                self.partial.discard(dirid)
+                if parent is not None:
+                    if partial:
+                        self.partial.add(parent)
+                    totals = self.nodes[parent][3]
+                    totals.Merge(subtree)
+                    totals.directories += 1
+            if not partial:
+                row = subtree.Row()
+                row.update(own.Row('own_'), directory_id = dirid, job_id = self.job_id)
+                self.results.put(('rollup', row))
+            dirid = parent
+
+
+class PriorEntry:
+    """
+    Stands in for the os.DirEntry of a subdirectory we know about from
+    the previous job, without having to list its parent
+    """
+
+    __slots__ = ('name', 'path')
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self, follow_symlinks=True):
+        return True
+
+    def is_file(self, follow_symlinks=True):
+        return False
+
+
+def OnlyDirectories(entries):
+    """
+    Just the directories among entries, from os.scandir, which is
+    closed when this is
+    """
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield entry
+
+
+class Frame:
+    """
+    A directory part way through being walked. For an incremental scan
+    files and subdirs are what the previous job found in it, and are
+    whittled down as we go, so whatever is left has been deleted. The
+    files which were matched up with one of those go in seen. If the
+    previous job found too many files to hold at once, files and seen
+    are of one part of them at a time (see PreviousJob.Files), prior
+    being the directory in the previous job.
+    """
+
+    __slots__ = ('path', 'dirid', 'entries', 'files', 'subdirs', 'complete', 'totals', 'seen',
+                 'prior', 'part', 'parts')
+
+    def __init__(self, path, dirid, entries, files=None, subdirs=None, complete=False, totals=None,
+                 prior=None, parts=1):
+        self.path = path
+        self.dirid = dirid
+        self.entries = entries
+        self.files = files
+        self.subdirs = subdirs
+        self.complete = complete # Done before a resume, so only subdirectories are of interest
+        self.totals = totals if totals is not None else Totals() # Of the files directly in it
+        self.seen = {} # Cleaned name: (ID, path, size, inode) if taken to be unchanged, else None
+        self.prior = prior
+        self.part = 0 # Of the files, which is listed in full for each
+        self.parts = parts
+
+
+class Walker:
+    """
+    Walks a directory tree with a pool of worker threads. os.scandir
+    and stat release the GIL, so on high latency storage (NFS,
+    spinning arrays) several threads can usefully wait on the disks
+    at once.
+
+    Directories waiting to be scanned go on a bounded queue which
+    the workers drain. If the queue is full a worker simply descends
+    in to the subdirectory itself, keeping the open scandir iterators
+    on an explicit stack rather than recursing. So memory is bounded
+    by the queue size plus the depth of the tree, however many
+    entries a directory has, and there is no recursion limit.
+
+    Rows are not written by the workers but put on a (also bounded)
+    results queue as (kind, row) tuples for a single DB writer. Files
+    are not read here: if hasher is given they are passed to it and
+    checksummed while the walk carries on.
+
+    If previous (a PreviousJob) is given, directories whose mtime and
+    size haven't changed since then aren't listed: their files are
+    copied from the previous job in the DB, and only their
+    subdirectories are visited. Files whose size and mtime haven't
+    changed keep their checksums, and additions and deletions are
+    recorded in the change table. Note that a file rewritten in place
+    doesn't change its directory's mtime, so won't be noticed in an
+    otherwise unchanged directory: do a full scan every so often.
+
+    Each directory is marked complete once all its files are written.
+    One which can't be read to the end is left incomplete, and counted
+    as unfinished in stats, so the job can be carried on with --resume.
+    If resumed (a ResumedJob) is given we are carrying on with an
+    interrupted job, so directories already in the DB keep their IDs,
+    complete ones are only searched for subdirectories, and any files
+    written for incomplete ones are thrown away and scanned again.
+
+    As the walk finishes the whole subtree under a directory its totals
+    are added up (see Rollups) and go in the rollup table.
+
+    What is found, how long listing directories and stat'ing files
+    take, and the lengths of the queues, go in stats (see
+    InventoryStats).
+    """
+
+    MaxPending = 1000 # Directories queued for the workers
+
+    def __init__(self, job_id, hasher, results, previous=None, resumed=None, stats=None):
+        self.job_id = job_id
+        self.hasher = hasher
+        self.results = results
+        self.previous = previous
+        self.resumed = resumed
+        self.carry = bool(previous and hasher and previous.digest == hasher.algorithm)
+        self.pending = queue.Queue(maxsize=Walker.MaxPending)
+        self.stop = threading.Event()
+        self.rollups = Rollups(job_id, results)
+        self.stats = stats or InventoryStats.Stats()
+        self.stats.Gauge('queued_directories', self.pending.qsize)
+        self.stats.Gauge('queued_rows', results.qsize)
+
+    def Worker(self):
+        """
+        Thread body: scan directories from the pending queue until
+        told to stop by a None.
+        """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
             try:
-                with os.scandir(directory) as di:
-                    for entry in di:
-                        if entry.is_dir():
-                            ProcessDirectory(session, os.path.join(directory, entry.name), 
-                                             job_id, compute_md5, d.id)
-                        if entry.is_file():
-                            logging.debug('Processing file {}'.format(entry.name))
-                            try:
-                                st = entry.stat()
-                            except FileNotFoundError:
-                                logging.warning("No such file or directory {}".format(entry.name))
-                            else:
-                                f = FileInventory.File(serial = next(FileInventory.File.Bates), parent = d.id, 
-                                         name = entry.name.encode('utf8')[-FileInventory.File.MaxFileNameLength:],
-                                         atime = datetime.datetime.fromtimestamp(st.st_atime), 
-                                         mtime = datetime.datetime.fromtimestamp(st.st_mtime), 
-                                         ctime = datetime.datetime.fromtimestamp(st.st_ctime), 
-                                         mode = st.st_mode, uid = st.st_uid, gid = st.st_gid,
-                                         size = st.st_size)
-                                if compute_md5:
-                                    f.md5sum = FileInventory.MD5(os.path.join(directory, entry.name))
-                                try:
-                                    session.add(f)
-                                    session.commit()
-                                except mysql.connector.errors.Error as e:
-                                    logging.error("Error committing file {}: {}".format(f.name, e))
-                                    session.rollback()
-
-            except PermissionError as e:
+                if not self.stop.is_set():
+                    self.Walk(*item)
+            except Exception:
+                self.stats.Add('walk_errors')
+                self.stats.Add('unfinished') # Whatever was left on its stack
+                logging.exception("Error walking {}".format(item[0]))
+            finally:
+                self.pending.task_done()
+
+    def Walk(self, directory, parent, prior=None, added=False):
+        """
+        Depth first walk from directory, handing subdirectories to
+        other workers where there is room on the queue.
+        """
+        stack = []
+        counter = self.stats.Counter() # This thread's, so can be updated directly
+        self.Enter(stack, directory, parent, prior, added)
+        while stack and not self.stop.is_set():
+            frame = stack[-1]
+            start = time.perf_counter()
+            try:
+                entry = next(frame.entries, None)
+                if entry is None and frame.part + 1 < frame.parts:
+                    self.NextPart(frame)
+                    continue
+            except OSError as e: # Not Leave, as what we have of it isn't all there is
+                logging.error("Error reading directory {}, leaving it for --resume: {}".format(frame.path, e))
+                counter['walk_errors'] += 1
+                counter['unfinished'] += 1
+                frame.entries.close()
+                stack.pop()
+                self.rollups.Abandon(frame.dirid)
+                continue
+            finally:
+                counter['scandir_s'] += time.perf_counter() - start
+                counter['scandir'] += 1
+            if entry is None:
+                self.Leave(frame)
+                stack.pop()
+            elif entry.is_dir(follow_symlinks=False): # Without a recursion limit a symlink loop would never end
+                if frame.part: # Found the first time through
+                    continue
+                prior = None
+                if frame.subdirs is not None:
+                    name = FileInventory.Directory.CleanName(entry.name)
+                    priors = frame.subdirs.pop(name, None)
+                    if priors and len(priors) == 1:
+                        prior = priors[0]
+                    elif priors: # Can't tell which is which, so all have gone and this is new
+                        frame.subdirs[name] = priors
+                item = (entry.path, frame.dirid, prior, frame.subdirs is not None and prior is None)
+                self.rollups.Expect(frame.dirid)
+                try:
+                    self.pending.put_nowait(item)
+                except queue.Full:
+                    self.Enter(stack, *item)
+            elif not frame.complete:
+                self.File(frame, entry, counter)
+        for frame in stack: # Only left over if we have been stopped
+            frame.entries.close()
+
+    def Enter(self, stack, directory, parent, prior, added):
+        """
+        Record a directory and push it on to the stack. Parameter
+        parent is the ID of the parent directory, so is None for the
+        root of the tree, and prior is the ID of the same directory in
+        the previous job, if any.
+        """
+        logging.info("Processing directory {}".format(directory))
+        try:
+            st = os.stat(directory)
+        except OSError as e: # Gone, or can't be got at: either way there is nothing to record
+            logging.warning("Can't stat directory {}: {}".format(directory, e))
+            self.stats.Add('walk_errors')
+            self.rollups.Release(parent)
+            return
+        self.stats.Add('directories')
+        # If there is no parent then there is no relative directory name
+        raw = os.path.split(directory)[1] if parent else None
+        name = FileInventory.Directory.CleanName(raw) if parent else None
+        existing = self.resumed.Lookup(parent, name, raw, st) if self.resumed else None
+        if existing:
+            dirid, complete = existing
+        else:
+            complete = False
+            serial = next(FileInventory.Directory.Bates)
+            dirid = FileInventory.Directory.MakeID(self.job_id, serial)
+            self.results.put(('directory', dict(id = dirid, serial = serial, name = name,
+                    job_id = self.job_id, parent = parent, complete = False,
+                    atime = datetime.datetime.fromtimestamp(st.st_atime), 
+                    mtime = datetime.datetime.fromtimestamp(st.st_mtime), 
+                    ctime = datetime.datetime.fromtimestamp(st.st_ctime), 
+                    mode = st.st_mode, uid = st.st_uid, gid = st.st_gid,
+                    size = st.st_size)))
+            if added:
+                self.results.put(('change', dict(job_id = self.job_id, kind = FileInventory.Change.Added,
+                                                 directory_id = dirid)))
+        self.rollups.Start(dirid, parent)
+        lossy = raw is not None and FileInventory.Directory.NameRe.search(raw) is not None
+        unchanged = prior is not None and self.previous.Unchanged(prior, st, lossy)
+        subdirs = dict(self.previous.children[prior]) if prior is not None else None
+        if complete:
+            own = self.resumed.Own(dirid)
+            try:
+                entries = self.Subdirectories(directory, subdirs) if unchanged else os.scandir(directory)
+            except OSError as e:
+                logging.error("Can't read directory {}: {}".format(directory, e))
+                self.stats.Add('walk_errors')
+                self.rollups.Done(dirid, own)
+                return
+            stack.append(Frame(directory, dirid, entries, None, subdirs, complete=True, totals=own))
+            return
+        if existing or (prior is not None and self.resumed and self.resumed.Known(parent, name)):
+            # Also clears deletions recorded under a sibling's row we couldn't claim
+            self.results.put(('purge', dict(job_id = self.job_id, dirid = dirid, prior = prior)))
+        if unchanged:
+            logging.debug("Directory {} unchanged".format(directory))
+            try:
+                entries = self.Subdirectories(directory, subdirs)
+            except OSError as e:
                 logging.error("Can't read directory {}: {}".format(directory, e))
+                self.stats.Add('walk_errors')
+                self.rollups.Done(dirid, Totals())
+                return
+            self.results.put(('copy', dict(prior = prior, parent = dirid, digests = self.carry,
+                    offset = (self.job_id - self.previous.id) * FileInventory.File.IDBlock)))
+            stack.append(Frame(directory, dirid, entries, None, subdirs, totals=self.previous.Own(prior)))
+            return
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            logging.error("Can't read directory {}: {}".format(directory, e))
+            self.stats.Add('walk_errors')
+            self.rollups.Done(dirid, Totals())
+            return
+        if prior is not None:
+            parts = self.previous.Parts(prior)
+            stack.append(Frame(directory, dirid, entries, self.previous.Files(prior, 0, parts), subdirs,
+                               prior=prior, parts=parts))
         else:
-            logging.warning("{} is not a directory.".format(directory))
+            stack.append(Frame(directory, dirid, entries))
+
+    @staticmethod
+    def Subdirectories(directory, subdirs):
+        """
+        The subdirectories of an unchanged directory, whose files we
+        don't need. They are known from the previous job, but only by
+        their names as cleaned, so if cleaning might have changed any
+        of those the directory has to be listed after all.
+        """
+        if any('?' in name for name in subdirs):
+            return OnlyDirectories(os.scandir(directory))
+        return (PriorEntry(directory, name) for name in list(subdirs))
+
+    def Leave(self, frame):
+        """
+        Finished with a directory: anything the previous job found in
+        it that we haven't seen has gone
+        """
+        frame.entries.close()
+        if frame.complete:
+            self.rollups.Done(frame.dirid, frame.totals)
+            return
+        self.Deleted(frame)
+        for priors in (frame.subdirs or {}).values():
+            for prior in priors:
+                self.results.put(('change', dict(job_id = self.job_id, kind = FileInventory.Change.Deleted,
+                                                 directory_id = prior)))
+        self.results.put(('done', dict(dirid = frame.dirid)))
+        self.rollups.Done(frame.dirid, frame.totals)
+
+    def NextPart(self, frame):
+        """
+        Finished with a part of the files of a directory too big to do
+        in one go: those of the previous job's which we haven't seen
+        have gone. List it again for the next part.
+        """
+        frame.entries.close()
+        self.Deleted(frame)
+        frame.part += 1
+        frame.files = self.previous.Files(frame.prior, frame.part, frame.parts)
+        frame.seen = {}
+        frame.entries = os.scandir(frame.path)
+
+    def Deleted(self, frame):
+        """
+        Record the previous job's files left in a frame as deleted
+        """
+        for rows in (frame.files or {}).values():
+            for row in rows:
+                self.results.put(('change', dict(job_id = self.job_id, kind = FileInventory.Change.Deleted,
+                                                 file_id = row.id)))
+
+    def File(self, frame, entry, counter):
+        """
+        Stat a file and queue its row, and if we are computing checksums,
+        queue it for the hasher. What we find is counted in counter, the
+        calling thread's (see InventoryStats.Stats.Counter). Anything
+        else which isn't a directory (sockets, devices and the like) is
+        ignored.
+        """
+        logging.debug('Processing file %s', entry.name) # Not formatted unless wanted, as this is per file
+        if frame.files is not None:
+            name = FileInventory.File.CleanNames([entry.name])[0]
+            if not PreviousJob.InPart(name, frame.part, frame.parts):
+                return
+        start = time.perf_counter()
+        try:
+            if not entry.is_file(): # Follows symlinks, so can fail as stat can
+                return
+            st = entry.stat()
+        except OSError as e:
+            logging.warning("Can't stat file {}: {}".format(entry.path, e))
+            counter['walk_errors'] += 1
+            return
+        counter['stat_s'] += time.perf_counter() - start
+        counter['stat'] += 1
+        counter['files'] += 1
+        counter['bytes'] += st.st_size
+        serial = next(FileInventory.File.Bates)
+        fileid = FileInventory.File.MakeID(self.job_id, serial)
+        md5sum = None
+        if frame.files is not None:
+            rows = frame.files.get(name)
+            if rows is None and name not in frame.seen:
+                self.results.put(('change', dict(job_id = self.job_id, kind = FileInventory.Change.Added,
+                                                 file_id = fileid)))
+            else:
+                # If there is more than one file of this name, then or now, we can't tell which
+                # was which, so they are all taken to have been modified
+                collided = name in frame.seen or len(rows) > 1
+                if rows:
+                    old = rows.pop()
+                    if not rows:
+                        del frame.files[name]
+                if not collided and old.size == st.st_size and PreviousJob.Same(old.mtime, st.st_mtime):
+                    if self.carry:
+                        md5sum = old.md5sum
+                    frame.seen[name] = (fileid, entry.path, st.st_size, entry.inode())
+                else:
+                    self.results.put(('change', dict(job_id = self.job_id, kind = FileInventory.Change.Modified,
+                                                     file_id = fileid)))
+                    if frame.seen.get(name):
+                        self.Collided(frame, *frame.seen[name])
+                    frame.seen[name] = None
+        frame.totals.Add(st.st_size, st.st_ctime, st.st_mtime)
+        self.results.put(('file', InventoryWriter.FileRecord(fileid, serial, frame.dirid, entry.name,
+                st.st_atime, st.st_mtime, st.st_ctime, st.st_mode, st.st_uid, st.st_gid, st.st_size, md5sum)))
+        if self.hasher and md5sum is None:
+            self.hasher.Submit(fileid, entry.path, st.st_size, self.results, frame.dirid, entry.inode())
+
+    def Collided(self, frame, fileid, path, size, inode):
+        """
+        A file taken to be unchanged turns out to have the same name,
+        once cleaned, as another, so may have been matched up with the
+        wrong one of the previous job's files
+        """
+        self.results.put(('change', dict(job_id = self.job_id, kind = FileInventory.Change.Modified,
+                                         file_id = fileid)))
+        if self.carry: # Its checksum was copied, perhaps from the other file
+            self.hasher.Submit(fileid, path, size, self.results, frame.dirid, inode)
+
+
+def Drain(results, writer):
+    """
+    Hand rows from the walkers to the writer until we get a None,
+    which means the walk has finished. Rows are dicts of keyword
+    arguments, except for files, the bulk of them, which are kept
+    as light as possible (see InventoryWriter.FileRecord).
+    """
+    add = {'directory': writer.AddDirectory, 'digest': writer.AddDigest,
+           'done': writer.AddDone, 'rollup': writer.AddRollup}
+    if writer.Incremental:
+        add.update({'copy': writer.AddCopy, 'change': writer.AddChange, 'purge': writer.AddPurge})
+    while True:
+        item = results.get()
+        if item is None:
+            break
+        kind, row = item
+        if kind == 'file':
+            writer.AddFile(row)
+        else:
+            add[kind](**row)
+
+
+def ProcessDirectory(writer, directory, job_id, hasher=None, workers=1, previous=None, resumed=None):
+    """
+    Scans the files in a directory tree, and sticks them in the 
+    database. Note that as a directory potentially contains
+    several million records, rows are handed to writer which
+    inserts them in batches to avoid both memory exhaustion
+    and a DB round trip per file.
+    
+    The tree is scanned by a Walker with the given number of
+    threads, while this thread hands what they find to writer.
+    An InventoryWriter.AsyncWriter writes it from threads (and
+    sessions) of its own, so the DB and the disks are busy at
+    once, and the walk is held back if the DB falls behind.
+    Either way writer.session is only ever used from this
+    thread. If hasher (a
+    HashInventory.HashPool) is given, files are checksummed as
+    we go, as far as it can keep up. If previous (a PreviousJob
+    for the same directory) is given, only what has changed since
+    then is scanned. If resumed (a ResumedJob) is given, we carry
+    on from where it was interrupted. How it goes is counted in
+    writer.stats (see InventoryStats).
+    """
+    if (previous or resumed) and not writer.Incremental:
+        raise ValueError("Incremental scans and resuming need a writer to the DB")
+    if not os.path.isdir(directory):
+        logging.warning("{} is not a directory.".format(directory))
+        return
+    results = queue.Queue(maxsize=2 * writer.batch_size)
+    walker = Walker(job_id, hasher, results, previous, resumed, writer.stats)
+    walker.pending.put((directory, None, previous.root if previous else None, False))
+    threads = [threading.Thread(target=walker.Worker, daemon=True) for _ in range(max(1, workers))]
+    for t in threads:
+        t.start()
+
+    def Finish(): # Tell Drain when there is nothing left to walk
+        walker.pending.join()
+        if hasher:
+            hasher.Wait()
+        for _ in threads:
+            walker.pending.put(None)
+        results.put(None)
+    threading.Thread(target=Finish, daemon=True).start()
+
+    try:
+        Drain(results, writer)
+    except (sqlalchemy.exc.DBAPIError, InventoryWriter.WriterError) as e:
+        logging.critical("Can't write to the DB ({}). Carry on later with --resume {}".format(e, job_id))
+        walker.stop.set()
+        if hasher:
+            hasher.Cancel()
+        sys.exit(1)
     except KeyboardInterrupt:
         # We check for keyboard interrupt (Ctrl-C) not only to handle such situations
-        # gracefully but also becuase if we haven't committed this can cause table
+        # gracefully but also becuase if we haven't flushed this can cause table
         # locks which (in extremis) mean we might have to restart the database
-        logging.error("Job interrupted by user!")
-        session.commit()
-        session.close()
+        logging.error("Job interrupted by user! Carry on with --resume {}".format(job_id))
+        walker.stop.set()
+        if hasher:
+            hasher.Cancel()
+        if writer.session is not None:
+            writer.session.rollback() # In case we were interrupted mid-flush
+        Drain(results, writer) # Keep what has already been scanned
+        writer.Close()
+        if writer.session is not None:
+            writer.session.close()
         sys.exit(0)
-    session.commit()
-    
+    for t in threads:
+        t.join()
+
+def Snapshot(args):
+    """
+    Scan args.dirs in to files in args.output rather than the DB (see
+    InventoryWriter.ColumnarWriter), for analysis with e.g.
+    AnalyseInventory.py --input. Each directory is a job, numbered
+    from 1 as there is no DB to allocate IDs.
+    """
+    if args.incremental or args.resume:
+        logging.critical("Incremental scans and resuming need the DB, not --output")
+        sys.exit(1)
+    stats = InventoryStats.Stats()
+    try:
+        writer = InventoryWriter.ColumnarWriter(args.output, args.commit_rec, args.format, stats)
+    except ValueError as e:
+        logging.critical("Can't write {}: {}".format(args.format, e))
+        sys.exit(1)
+    # No DB to catch up with checksums from afterwards, so the walk waits for the hashers
+    hasher = HashInventory.HashPool(args.hash_workers, args.digest, args.chunk_size, wait=True, stats=stats,
+                                    throttle=HashInventory.MakeThrottle(args.max_rate, args.max_iops,
+                                    args.max_latency, args.chunk_size)) if args.digest else None
+    try:
+        for job_id, d in enumerate(args.dirs, 1):
+            pathname = os.path.abspath(d)
+            started = datetime.datetime.now()
+            ended = None
+            progress = InventoryStats.Progress(stats, args.progress, args.metrics).Start()
+            try:
+                ProcessDirectory(writer, pathname, job_id, hasher, args.workers)
+                ended = datetime.datetime.now()
+            finally: # Even if interrupted, so what was scanned has its job (without an end)
+                writer.AddJob(id=job_id, started=started, ended=ended, path=pathname,
+                              owner=args.user, host=socket.gethostname(), digest=args.digest,
+                              comment=args.description[:FileInventory.Job.MaxCommentLength] if args.description else None,
+                              **InventoryStats.Stats.Summary(progress.Stop()))
+                writer.Flush()
+    finally:
+        writer.Stop()
+    if hasher:
+        hasher.Close()
+
 if __name__ == '__main__':
     args = GetArgs()
-    while not (args.blank or args.password): # Prompt for a password if required
+    while not (args.blank or args.password or args.local or args.output): # Prompt for a password if required
         args.password = getpass.getpass()
 
     if not args.verbose: # Is None if not specified
@@ -152,6 +1038,10 @@ if __name__ == '__main__':
     loglevels = [logging.WARNING, logging.INFO, logging.DEBUG]
     level = loglevels[min(args.verbose, len(loglevels)- 1)]
     logging.basicConfig(level = level, format = '%(asctime)s %(message)s')
+
+    if args.output: # No DB at all
+        Snapshot(args)
+        sys.exit(0)
     
     if args.password:
         connectstr = '{}://{}:{}@{}/{}'.format(args.connector, args.user, 
@@ -161,8 +1051,11 @@ if __name__ == '__main__':
                       args.host, args.schema)
         
     try:
-        engine = create_engine(connectstr, pool_recycle=3600, 
-                               echo = True if args.sql_debug else False)
+        if args.local:
+            engine = FileInventory.LocalEngine(args.local, echo = True if args.sql_debug else False)
+        else:
+            engine = create_engine(connectstr, pool_recycle=3600, 
+                                   echo = True if args.sql_debug else False)
     except sqlalchemy.exc.NoSuchModuleError as e:
         logging.critical("Error creating engine: {}".format(e))
     else:
@@ -170,27 +1063,88 @@ if __name__ == '__main__':
         try:
             if args.nuke:
                 logging.info("Dropping existing tables")
-                FileInventory.File.__table__.drop(engine, checkfirst = True)
-                FileInventory.Directory.__table__.drop(engine, checkfirst = True)
-                FileInventory.Job.__table__.drop(engine, checkfirst = True)
+                FileInventory.Base.metadata.drop_all(engine, checkfirst = True)
+            FileInventory.Layout.Setup(engine, args.compact)
             FileInventory.Base.metadata.create_all(engine, checkfirst = True)
         except sqlalchemy.exc.ProgrammingError as e:
             logging.critical("Error creating tables: {}".format(e))
         else:
             logging.info("Creating session")
             session = Session()
+            stats = InventoryStats.Stats() # For the whole run: Progress works out each job's share
+            if args.db_writers:
+                writer = InventoryWriter.AsyncWriter(session, args.commit_rec, stats, args.db_writers)
+            else:
+                writer = InventoryWriter.BatchWriter(session, args.commit_rec, stats)
+            resumed = None
+            if args.resume:
+                try:
+                    resumed = ResumedJob(session, args.resume)
+                except ValueError as e:
+                    logging.critical("Can't resume: {}".format(e))
+                    sys.exit(1)
+                args.digest = resumed.job.digest
+                args.incremental = resumed.job.previous
+                args.dirs = [resumed.job.path]
+            previous = None
+            if args.incremental:
+                try:
+                    previous = PreviousJob(session, args.incremental)
+                except ValueError as e:
+                    logging.critical("Can't do incremental scan: {}".format(e))
+                    sys.exit(1)
+                if not args.digest: # Carry on checksumming as before
+                    args.digest = previous.digest
+            hasher = HashInventory.HashPool(args.hash_workers, args.digest, args.chunk_size, stats=stats,
+                                            throttle=HashInventory.MakeThrottle(args.max_rate, args.max_iops,
+                                            args.max_latency, args.chunk_size)) if args.digest else None
             if args.description:
                 args.description = args.description[:FileInventory.Job.MaxCommentLength]
             for d in args.dirs:
                 pathname = os.path.abspath(d)
-                job = FileInventory.Job(host=socket.gethostname(), owner=args.user, 
-                          comment=args.description, path = pathname,
-                          md5sum = True if args.md5sum else False)
-                session.add(job)
-                session.commit()
-                ProcessDirectory(session, pathname, 
-                                 job.id, args.md5sum, parent=None)                    
-                job.ended = datetime.datetime.now()
-                session.commit()
+                base = previous
+                if previous and previous.path != pathname:
+                    logging.warning("Job {} was of {} not {}, so scanning it all".format(
+                            previous.id, previous.path, pathname))
+                    base = None
+                # Only a full scan can be expected to go through as many files as last time
+                expected = ExpectedFiles(session, pathname) if not (base or resumed) else None
+                if resumed:
+                    job = resumed.job
+                else:
+                    job = FileInventory.Job(host=socket.gethostname(), owner=args.user, 
+                              comment=args.description, path = pathname,
+                              digest = args.digest, previous = base.id if base else None)
+                    session.add(job)
+                    session.commit()
+                    if base:
+                        FileInventory.File.Bates = itertools.count(base.next_serial)
+                progress = InventoryStats.Progress(stats, args.progress, args.metrics, expected).Start()
+                ProcessDirectory(writer, pathname, 
+                                 job.id, hasher, args.workers, base, resumed)                    
+                try: # The walk is done, but its last batches, and the catching up, can still fail
+                    writer.Close()
+                    if hasher: # Catch up with anything the walk got ahead of
+                        HashInventory.HashJob(writer, hasher, job.id)
+                        writer.Close()
+                    totals = progress.Stop()
+                    for name, value in JobTotals(session, job, totals, resumed is not None).items():
+                        setattr(job, name, value)
+                    if totals['unfinished']: # Not ended, so it can be resumed
+                        logging.error("{} directories couldn't be read to the end. Carry on later with --resume {}".format(
+                                totals['unfinished'], job.id))
+                    else:
+                        if resumed:
+                            resumed.Drop(session)
+                        job.ended = datetime.datetime.now()
+                    session.commit()
+                except (sqlalchemy.exc.DBAPIError, InventoryWriter.WriterError) as e:
+                    logging.critical("Can't write to the DB ({}). Carry on later with --resume {}".format(e, job.id))
+                    if hasher:
+                        hasher.Cancel()
+                    sys.exit(1)
+            if hasher:
+                hasher.Close()
+            writer.Stop()
             logging.info("Closing session")
             session.close()